@@ -1,15 +1,77 @@
-from flask import Flask, render_template, session, redirect, url_for, request, flash, jsonify, abort
-import json, os
+from flask import (
+    Flask, render_template, stream_template, session, redirect, url_for, request, flash, jsonify, abort, make_response
+)
+from markupsafe import Markup
+import gc, json, os, re, errno, sys, codecs, shutil, math, time, mmap, zlib, fcntl, struct, atexit, bisect, heapq, hashlib, secrets, sqlite3, threading, unicodedata
+from array import array
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
 from functools import wraps
-from datetime import datetime
+from operator import itemgetter
+from itertools import islice
+from datetime import date, datetime
+
+try:
+    import numpy as np      # order analytics only
+except ImportError:
+    np = None
 
 app = Flask(__name__)
 app.secret_key = "dhruba_secret_key_change_this"
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 PRODUCTS_FILE = os.path.join(BASE_DIR, "products.json")
-USERS_FILE = os.path.join(BASE_DIR, "users.json")
-ORDERS_FILE = os.path.join(BASE_DIR, "orders.json")
+USERS_FILE = os.path.join(BASE_DIR, "users.json")        # legacy, split up once
+USERS_DIR = os.path.join(BASE_DIR, "users")
+ORDERS_FILE = os.path.join(BASE_DIR, "orders.json")      # legacy, imported once
+ORDERS_JOURNAL = os.path.join(BASE_DIR, "orders.jsonl")
+PRODUCTS_LOG = os.path.join(BASE_DIR, "products.log")    # JSON backend: product changes since products.json
+
+# "always": fsync every order; "batch": group-commit fsync from the
+# persistence worker; "never": leave flushing to the OS
+ORDERS_FSYNC = os.environ.get("ORDERS_FSYNC", "always")
+
+# products.log is folded into products.json once it grows past this
+PRODUCTS_LOG_MAX = int(os.environ.get("PRODUCTS_LOG_MAX", 8 * 1024 * 1024))
+
+# "json" (files next to app.py) or "sqlite" (WAL-mode database at SQLITE_PATH)
+STORAGE = os.environ.get("STORAGE", "json")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", os.path.join(BASE_DIR, "store.db"))
+
+# "session" keeps the cart in the signed cookie; "memory" and "sqlite" keep
+# it server-side and put only an opaque id in the cookie
+CART_STORE = os.environ.get("CART_STORE", "session")
+CART_DB = os.environ.get("CART_DB", os.path.join(BASE_DIR, "carts.db"))
+CART_TTL = int(os.environ.get("CART_TTL", 7 * 24 * 3600))
+CART_MEMORY_BUDGET = int(os.environ.get("CART_MEMORY_BUDGET", 64 * 1024 * 1024))
+
+# size cap for cached page fragments; 0 disables the cache
+PAGE_CACHE_BYTES = int(os.environ.get("PAGE_CACHE_BYTES", 32 * 1024 * 1024))
+
+# binary copy of products.json for fast startup; "" disables it
+SNAPSHOT_FILE = os.environ.get("SNAPSHOT_FILE", os.path.join(BASE_DIR, "products.snap"))
+
+# build every index up front and freeze the heap for fork-sharing; meant
+# for `gunicorn --preload`, where the master imports the app once
+SHARED_CATALOG = os.environ.get("SHARED_CATALOG") == "1"
+
+# shared catalog version counter, mapped by every gunicorn worker
+VERSION_FILE = os.environ.get("VERSION_FILE", os.path.join(BASE_DIR, "catalog.version"))
+
+# JSON backend: shared product and order id counters, stock levels and
+# claimed checkout idempotency keys
+PRODUCT_IDS_FILE = os.environ.get("PRODUCT_IDS_FILE", os.path.join(BASE_DIR, "product.ids"))
+ORDER_IDS_FILE = os.environ.get("ORDER_IDS_FILE", os.path.join(BASE_DIR, "order.ids"))
+STOCK_FILE = os.environ.get("STOCK_FILE", os.path.join(BASE_DIR, "stock.levels"))
+CHECKOUT_KEYS_DIR = os.path.join(BASE_DIR, "checkout_keys")
+CHECKOUT_KEY_TTL = int(os.environ.get("CHECKOUT_KEY_TTL", 24 * 3600))
+
+# seconds between rewrites of the same file by the persistence worker
+PERSIST_INTERVAL = float(os.environ.get("PERSIST_INTERVAL", 1.0))
+
+# listing, history and API page sizes
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 24))
+MAX_PAGE_SIZE = 200
 
 # Admin login
 ADMIN_USERNAME = "dhruba"
@@ -28,9 +90,408 @@ def load_json(path, default):
         return default
 
 
+# Write to a temp file and rename over the target, so readers never see a
+# half-written file.
 def save_json(path, data):
-    with open(path, "w", encoding="utf-8") as f:
+    tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    with open(tmp, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=2, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# Create path holding data only if it doesn't exist yet; link() makes the
+# check and the creation one step, also across processes.
+def create_exclusive(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    save_json(tmp, data)
+    try:
+        os.link(tmp, path)
+    except FileExistsError:
+        return False
+    finally:
+        os.unlink(tmp)
+    return True
+
+
+# -------------------- PERSISTENCE --------------------
+# Background worker for file writes. Request handlers only mark a file
+# dirty; the worker flushes each file at most once per interval, so a burst
+# of ratings costs one rewrite instead of one per request.
+class Persister:
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = {}           # key -> flush action
+        self.flushed_at = {}        # key -> time.monotonic() of the last flush
+        self.cond = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.stats = {"flushes": 0, "coalesced": 0, "errors": 0, "last_flush_ms": 0.0, "max_flush_ms": 0.0}
+
+    def mark(self, key, action):
+        with self.cond:
+            if key in self.pending:
+                self.stats["coalesced"] += 1
+            self.pending[key] = action
+            # started lazily so each forked gunicorn worker gets its own thread
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="persister", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                now = time.monotonic()
+                due = {k: a for k, a in self.pending.items()
+                       if self.flushed_at.get(k, -math.inf) + self.interval <= now}
+                if not due:
+                    self.cond.wait(min(self.flushed_at[k] + self.interval for k in self.pending) - now)
+                    continue
+                for key in due:
+                    del self.pending[key]
+                    self.flushed_at[key] = now
+            self.flush(due)
+
+    def flush(self, batch):
+        with self.flush_lock:
+            for key, action in batch.items():
+                start = time.perf_counter()
+                try:
+                    action()
+                except Exception:
+                    self.stats["errors"] += 1
+                    app.logger.exception("persisting %s failed", key)
+                    with self.cond:
+                        self.pending.setdefault(key, action)
+                    continue
+                ms = (time.perf_counter() - start) * 1000
+                self.stats["flushes"] += 1
+                self.stats["last_flush_ms"] = round(ms, 3)
+                self.stats["max_flush_ms"] = round(max(self.stats["max_flush_ms"], ms), 3)
+
+    def flush_all(self):
+        with self.cond:
+            batch, self.pending = self.pending, {}
+        self.flush(batch)
+
+    def snapshot(self):
+        with self.cond:
+            return dict(self.stats, pending=len(self.pending), interval=self.interval)
+
+
+persister = Persister(PERSIST_INTERVAL)
+atexit.register(persister.flush_all)
+
+
+# -------------------- JOURNALS --------------------
+# Orders, and the JSON backend's product changes, are appended as one JSON
+# line each, so a checkout or a rating costs one small write no matter
+# how much history exists. O_APPEND keeps lines from different gunicorn
+# workers intact. Appends hold a shared lockf on
+# <journal>.lock and compaction an exclusive one, so compacting under a
+# running server loses nothing: appends wait for it, then find the file
+# replaced and reopen it.
+class Journal:
+    def __init__(self, path, fsync="always"):
+        self.path = path
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.fd = None
+        self.lock_fd = None
+
+    @contextmanager
+    def locked(self, how):
+        if self.lock_fd is None:
+            self.lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.lockf(self.lock_fd, how)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self.lock_fd, fcntl.LOCK_UN)
+
+    # the open journal, reopened if compaction replaced the file
+    def open(self):
+        if self.fd is not None:
+            try:
+                current = os.stat(self.path).st_ino == os.fstat(self.fd).st_ino
+            except FileNotFoundError:
+                current = False
+            if not current:
+                os.close(self.fd)
+                self.fd = None
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            # end a torn line left by a crash so the next record isn't glued to it
+            size = os.fstat(self.fd).st_size
+            if size and os.pread(self.fd, 1, size - 1) != b"\n":
+                os.write(self.fd, b"\n")
+        return self.fd
+
+    def replay(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # torn write from a crash; compaction drops it
+                    continue
+
+    # Complete lines from byte offset on: (records, offset after them, inode).
+    # A line without its newline yet is left for the next call.
+    def read_from(self, offset=0):
+        records = []
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return records, 0, None
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+        return records, offset, inode
+
+    # Records any worker appended after cursor, an (inode, offset) pair:
+    # (records, new cursor, whether they are the whole journal again). A
+    # compaction replaces the file, so a cursor into the old inode starts over.
+    def read_after(self, cursor):
+        inode, offset = cursor
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return [], cursor, False
+        if (st.st_ino, st.st_size) == cursor:
+            return [], cursor, False
+        records, end, found = self.read_from(offset if st.st_ino == inode else 0)
+        if found != inode and st.st_ino == inode:
+            # compacted between the stat and the read
+            records, end, found = self.read_from(0)
+        return records, (found, end), found != inode
+
+    def size(self):
+        return os.fstat(self.fd).st_size if self.fd is not None else 0
+
+    def append(self, record):
+        data = (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        with self.lock, self.locked(fcntl.LOCK_SH):
+            os.write(self.open(), data)
+            if self.fsync == "always":
+                os.fsync(self.fd)
+
+    def sync(self):
+        with self.lock:
+            if self.fd is not None:
+                os.fsync(self.fd)
+
+    # Rewrite the journal with one line per order id (latest wins).
+    def compact(self):
+        with self.lock, self.locked(fcntl.LOCK_EX):
+            latest = {}
+            for record in self.replay():
+                latest[record.get("id")] = record
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for record in latest.values():
+                    f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+        return len(latest)
+
+
+order_journal = Journal(ORDERS_JOURNAL, ORDERS_FSYNC)
+
+
+# Orders by id, plus all order ids and each user's order ids in sorted
+# arrays, so a page of someone's history is a bisect and a slice.
+class OrderIndex:
+    def __init__(self, items=()):
+        self.by_id = {}
+        self.ids = array("q")
+        self.by_user = {}       # username -> array of order ids
+        for order in items:
+            self.add(order)
+
+    def add(self, order):
+        if order["id"] in self.by_id:
+            return
+        self.by_id[order["id"]] = order
+        bisect.insort(self.ids, order["id"])
+        if order.get("user"):
+            bisect.insort(self.by_user.setdefault(order["user"], array("q")), order["id"])
+
+    # up to limit orders, newest first, with ids below `after`
+    def page(self, user=None, after=None, limit=PAGE_SIZE):
+        ids = self.ids if user is None else self.by_user.get(user, ())
+        end = len(ids) if after is None else bisect.bisect_left(ids, after)
+        return [self.by_id[i] for i in reversed(ids[max(0, end - limit):end])]
+
+
+# -------------------- SHARED COUNTERS --------------------
+# A 64-bit counter in a small mmap'd file. Reading it is a memory load, so
+# every request can check whether another worker changed the catalog.
+# lockf (per process) plus a thread lock serialise increments.
+class SharedCounter:
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size < 8:
+            os.ftruncate(self.fd, 8)
+        self.mm = mmap.mmap(self.fd, 8)
+        self.lock = threading.Lock()
+
+    def read(self):
+        return struct.unpack_from("<Q", self.mm)[0]
+
+    # add n (after raising the counter to at least floor); returns the new value
+    def bump(self, n=1, floor=0):
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                value = max(self.read(), floor) + n
+                struct.pack_into("<Q", self.mm, 0, value)
+                return value
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+
+shared_version = SharedCounter(VERSION_FILE)
+
+
+# Stock levels for the JSON backend, shared by all workers: slot i of an
+# mmap'd file holds stock + 1 for product id i, so 0 (what a fresh or
+# extended file reads as) means not tracked. A reservation locks only the
+# slots of the products involved, in id order so two baskets can't
+# deadlock: a striped thread lock within the process, and a lockf byte
+# range across processes. Slot 0 is never a product; its range guards
+# growing the file.
+class StockLevels:
+    STRIPES = 64
+    GROW = 64 * 1024
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.mm = None
+        self.map_lock = threading.Lock()
+        self.stripes = [threading.Lock() for _ in range(self.STRIPES)]
+
+    # the map if it covers pid's slot, remapping after another worker grew the file
+    def mapped(self, pid, grow=False):
+        end = 8 * (pid + 1)
+        if self.mm is None or len(self.mm) < end:
+            with self.map_lock:
+                size = os.fstat(self.fd).st_size
+                if size < end and grow:
+                    fcntl.lockf(self.fd, fcntl.LOCK_EX, 8, 0)
+                    try:
+                        size = os.fstat(self.fd).st_size
+                        if size < end:
+                            size = max(end, 2 * size, self.GROW)
+                            os.ftruncate(self.fd, size)
+                    finally:
+                        fcntl.lockf(self.fd, fcntl.LOCK_UN, 8, 0)
+                if size and (self.mm is None or len(self.mm) < size):
+                    self.mm = mmap.mmap(self.fd, size)
+        return self.mm if self.mm is not None and len(self.mm) >= end else None
+
+    def get(self, pid):
+        mm = self.mapped(pid)
+        value = struct.unpack_from("<q", mm, 8 * pid)[0] if mm is not None else 0
+        return value - 1 if value else None
+
+    def put(self, pid, stock):
+        if stock is None and self.mapped(pid) is None:
+            return      # past the end of the file: not tracked already
+        struct.pack_into("<q", self.mapped(pid, grow=True), 8 * pid, 0 if stock is None else stock + 1)
+
+    @contextmanager
+    def locked(self, pids):
+        stripes = [self.stripes[i] for i in sorted({pid % self.STRIPES for pid in pids})]
+        for lock in stripes:
+            lock.acquire()
+        held = []
+        try:
+            while len(held) < len(pids):
+                pid = pids[len(held)]
+                try:
+                    fcntl.lockf(self.fd, fcntl.LOCK_EX, 8, 8 * pid)
+                    held.append(pid)
+                except OSError as e:
+                    # POSIX locks belong to processes, so with threaded
+                    # workers the kernel can see a deadlock that isn't one
+                    if e.errno != errno.EDEADLK:
+                        raise
+                    while held:
+                        fcntl.lockf(self.fd, fcntl.LOCK_UN, 8, 8 * held.pop())
+                    time.sleep(0.001)
+            yield
+        finally:
+            while held:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 8, 8 * held.pop())
+            for lock in stripes:
+                lock.release()
+
+    def set(self, pid, stock):
+        with self.locked([pid]):
+            self.put(pid, stock)
+
+    # Take qty of every tracked product in items ({pid: qty}) or nothing:
+    # (True, units left per tracked product) or (False, units left of
+    # the products that are short).
+    def reserve(self, items):
+        want = {int(pid): qty for pid, qty in items.items()}
+        with self.locked(sorted(want)):
+            levels = {pid: n for pid, n in ((pid, self.get(pid)) for pid in want) if n is not None}
+            short = {pid: n for pid, n in levels.items() if n < want[pid]}
+            if short:
+                return False, short
+            for pid, n in levels.items():
+                self.put(pid, n - want[pid])
+        return True, {pid: n - want[pid] for pid, n in levels.items()}
+
+    # hand back a reservation whose order didn't go through
+    def release(self, items):
+        want = {int(pid): qty for pid, qty in items.items()}
+        with self.locked(sorted(want)):
+            for pid, qty in want.items():
+                n = self.get(pid)
+                if n is not None:
+                    self.put(pid, n + qty)
+
+    # Startup: the file has the live levels; products.json only seeds
+    # products the file doesn't track yet.
+    def sync(self, products):
+        live = array("q")
+        if self.mapped(0) is not None:
+            live.frombytes(self.mm)
+        for p in products:
+            value = live[p.id] if p.id < len(live) else 0
+            if value:
+                p.stock = value - 1
+            elif p.stock is not None:
+                with self.locked([p.id]):
+                    if self.get(p.id) is None:
+                        self.put(p.id, p.stock)
+                    p.stock = self.get(p.id)
+        return products
 
 
 # -------------------- DEFAULT DATA --------------------
@@ -44,46 +505,1974 @@ DEFAULT_USERS = [
 
 DEFAULT_ORDERS = []
 
-products = load_json(PRODUCTS_FILE, DEFAULT_PRODUCTS)
-users = load_json(USERS_FILE, DEFAULT_USERS)
-orders = load_json(ORDERS_FILE, DEFAULT_ORDERS)
+
+# -------------------- PRODUCTS --------------------
+# Products are __slots__ records rather than dicts: no per-instance dict,
+# category names interned, and a constant-size rating aggregate (count, sum,
+# and a 1..5 star histogram) instead of every rating. Templates and the
+# indexes share these records directly; only the routes mutate them, through
+# the catalog. The JSON form is unchanged apart from the rating aggregate.
+# stock is None for products whose stock isn't tracked.
+RATING_PRIOR_MEAN = 3.0
+RATING_PRIOR_WEIGHT = 5
+LOW_STOCK = 5       # product pages show exact stock at or below this
+
+
+class Product:
+    __slots__ = ("id", "name", "price", "img", "category", "featured", "rating_count", "rating_sum", "rating_hist", "stock")
+
+    def __init__(self, id, name, price, img="", category="Other", featured=False, rating_count=0, rating_sum=0, rating_hist=None,
+                 stock=None):
+        self.id = int(id)
+        self.name = name
+        self.price = price
+        self.img = img
+        self.category = sys.intern(category)
+        self.featured = featured is True
+        self.rating_count = rating_count
+        self.rating_sum = rating_sum
+        self.rating_hist = array("I", rating_hist or (0, 0, 0, 0, 0))
+        self.stock = stock
+
+    # Also folds the old "ratings" list into the aggregate.
+    @classmethod
+    def from_dict(cls, d):
+        agg = d.get("rating") or {}
+        p = cls(d["id"], d["name"], d["price"], d.get("img", ""), d.get("category", "Other"), d.get("featured", False),
+                agg.get("count", 0), agg.get("sum", 0), agg.get("hist"), d.get("stock"))
+        for r in d.get("ratings", ()):
+            if 1 <= int(r) <= 5:
+                p.add_rating(int(r))
+        return p
+
+    def to_dict(self):
+        return {
+            "id": self.id, "name": self.name, "price": self.price, "img": self.img,
+            "category": self.category, "featured": self.featured,
+            "rating": {"count": self.rating_count, "sum": self.rating_sum, "hist": list(self.rating_hist)},
+            "stock": self.stock
+        }
+
+    def set(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, sys.intern(value) if name == "category" else value)
+
+    def add_rating(self, rating):
+        self.rating_count += 1
+        self.rating_sum += rating
+        self.rating_hist[rating - 1] += 1
+
+    # hist[i] more (i + 1)-star ratings
+    def add_ratings(self, hist):
+        for i, n in enumerate(hist):
+            self.rating_count += n
+            self.rating_sum += (i + 1) * n
+            self.rating_hist[i] += n
+
+    @property
+    def avg_rating(self):
+        return self.rating_sum / self.rating_count if self.rating_count else None
+
+    # Average shrunk toward the prior, so one 5-star review doesn't top the list.
+    @property
+    def bayesian_rating(self):
+        return (RATING_PRIOR_MEAN * RATING_PRIOR_WEIGHT + self.rating_sum) / (RATING_PRIOR_WEIGHT + self.rating_count)
+
+
+# stock as product pages show it: untracked, the exact low count, or plenty
+def stock_band(stock):
+    return stock if stock is None or stock <= LOW_STOCK else "many"
+
+
+# one rating as a per-star histogram, the form storage.add_ratings takes
+def rating_hist(rating):
+    hist = [0] * 5
+    hist[rating - 1] = 1
+    return hist
+
+
+# everything stored of a record but the stock, to tell a sale from an edit
+def product_state(p):
+    if p is None:
+        return None
+    return p.name, p.price, p.img, p.category, p.featured, p.rating_count, p.rating_sum, p.rating_hist
+
+
+# -------------------- CATALOG SNAPSHOT --------------------
+# products.json laid out column by column: fixed-width int columns, then
+# NUL-joined name/img/category text. Loading maps the file and copies each
+# column out as one array instead of parsing JSON. The header records the
+# size and mtime of the products.json it was written from (as stat'ed
+# before that JSON was read), so a snapshot is ignored (and rebuilt) once
+# the JSON changes behind its back.
+SNAPSHOT_MAGIC = b"NOWLSNAP"
+SNAPSHOT_FORMAT = 2
+SNAPSHOT_HEADER = struct.Struct("<8sIIqqqQ")   # magic, format, crc32, json size, json mtime_ns, count, payload bytes
+
+
+def write_snapshot(path, products, source_stat):
+    categories = sorted({p.category for p in products})
+    code = {c: i for i, c in enumerate(categories)}
+    try:
+        columns = [
+            array("q", [p.id for p in products]),
+            array("q", [p.price for p in products]),
+            array("q", [p.rating_count for p in products]),
+            array("q", [p.rating_sum for p in products]),
+            array("q", [n for p in products for n in p.rating_hist]),
+            array("I", [code[p.category] for p in products]),
+            array("B", [p.featured for p in products]),
+            array("q", [-1 if p.stock is None else p.stock for p in products]),
+        ]
+    except (TypeError, OverflowError):
+        return False    # e.g. a float price; keep loading from JSON
+    parts = [column.tobytes() for column in columns]
+    for texts in (categories, [p.name for p in products], [p.img for p in products]):
+        blob = "\0".join(texts).encode("utf-8")
+        if blob.count(b"\0") != max(len(texts) - 1, 0):
+            return False
+        parts += [struct.pack("<Q", len(blob)), blob]
+    payload = b"".join(parts)
+    st = source_stat
+    tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    with open(tmp, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, zlib.crc32(payload),
+                                     st.st_size, st.st_mtime_ns, len(products), len(payload)))
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return True
+
+
+# Products from the snapshot, or None if it is missing, stale or corrupt.
+def read_snapshot(path, source):
+    try:
+        st = os.stat(source)
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    with mm:
+        if len(mm) < SNAPSHOT_HEADER.size:
+            return None
+        magic, fmt, crc, size, mtime_ns, n, length = SNAPSHOT_HEADER.unpack_from(mm)
+        if (magic, fmt, size, mtime_ns) != (SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, st.st_size, st.st_mtime_ns) \
+                or len(mm) != SNAPSHOT_HEADER.size + length or zlib.crc32(mm[SNAPSHOT_HEADER.size:]) != crc:
+            return None
+        pos = SNAPSHOT_HEADER.size
+
+        def column(typecode, count):
+            nonlocal pos
+            col = array(typecode)
+            col.frombytes(mm[pos:pos + col.itemsize * count])
+            pos += col.itemsize * count
+            return col
+
+        def texts():
+            nonlocal pos
+            (size,) = struct.unpack_from("<Q", mm, pos)
+            pos += 8 + size
+            return mm[pos - size:pos].decode("utf-8").split("\0")
+
+        ids, prices, counts, sums, hist = (column("q", n) for n in (n, n, n, n, 5 * n))
+        codes, featured, stock = column("I", n), column("B", n), column("q", n)
+        categories, names, imgs = texts(), texts(), texts()
+    return list(map(Product, ids, names, prices, imgs, map(categories.__getitem__, codes), map(bool, featured),
+                    counts, sums, (hist[i:i + 5] for i in range(0, 5 * n, 5)), (None if s < 0 else s for s in stock)))
+
+
+# -------------------- USERS --------------------
+# User records are dicts. The wishlist is a dict of pid -> None (a set that
+# keeps insertion order) in memory and a list on disk.
+def load_user(record):
+    record["wishlist"] = dict.fromkeys(record.get("wishlist", ()))
+    return record
+
+
+def user_record(user):
+    return dict(user, wishlist=list(user["wishlist"]))
+
+
+# users/<2 hex>/<blake2b of the name>.json: the file name is the index, and
+# the fan-out keeps directories small.
+def user_path(username):
+    digest = hashlib.blake2b(username.encode("utf-8"), digest_size=16).hexdigest()
+    return os.path.join(USERS_DIR, digest[:2], digest + ".json")
+
+
+# -------------------- STORAGE --------------------
+# Both backends expose the same operations the routes use. The catalog and
+# order list stay in memory; writes go through the backend.
+class JsonStorage:
+    def __init__(self):
+        self.users_by_name = {}     # username -> ((inode, mtime) of its file, user)
+        self.user_locks = {}        # users/<2 hex> directory -> thread lock
+        self.stock = StockLevels(STOCK_FILE)
+        self.product_log = Journal(PRODUCTS_LOG, "batch")
+        self.refresh_lock = threading.Lock()
+        self.seen_version = shared_version.read()
+        if not os.path.isdir(USERS_DIR):
+            self.split_users()
+
+    # One-time move from users.json to one file per user. Built in a temp
+    # directory and renamed, so a crash or a racing worker leaves either
+    # nothing or a complete directory.
+    def split_users(self):
+        tmp = "%s.%d.tmp" % (USERS_DIR, os.getpid())
+        for user in load_json(USERS_FILE, DEFAULT_USERS):
+            path = tmp + user_path(user["username"])[len(USERS_DIR):]
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(user_record(load_user(user)), f, indent=2, ensure_ascii=False)
+        os.makedirs(tmp, exist_ok=True)
+        os.sync()   # one flush for the whole tree instead of one per file
+        try:
+            os.rename(tmp, USERS_DIR)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    # Products are products.json plus the changes in products.log. Every
+    # product write appends one line to the log, so it costs the same at
+    # any catalog size, and other workers apply just those lines. Once the
+    # log passes PRODUCTS_LOG_MAX a worker folds it into products.json.
+    def load_products(self):
+        products, self.log_cursor = self.read_state()
+        products = self.stock.sync(products)
+        # New products take ids from the shared counter, so two workers
+        # adding at once never pick the same one.
+        self.product_ids = SharedCounter(PRODUCT_IDS_FILE)
+        self.product_floor = max((p.id for p in products), default=0)
+        return products
+
+    # products.json with the whole log applied, and the log cursor after it.
+    # Under the log's exclusive lock, so no fold is half done.
+    def read_state(self):
+        log = self.product_log
+        with log.lock, log.locked(fcntl.LOCK_EX):
+            self.finish_fold()
+            products = Catalog(self.read_products())
+            log.open()      # created now, so the first change doesn't look like a fold
+            records, end, inode = log.read_from()
+            self.apply_changes(products, records)
+        return products.to_list(), (inode, end)
+
+    # With cache, a snapshot is written for next time if there was none.
+    def read_products(self, cache=True):
+        products = read_snapshot(SNAPSHOT_FILE, PRODUCTS_FILE) if SNAPSHOT_FILE else None
+        if products is not None:
+            return products
+        items = load_json(PRODUCTS_FILE, DEFAULT_PRODUCTS)
+        products = [Product.from_dict(d) for d in items]
+        if any("ratings" in d for d in items):
+            save_json(PRODUCTS_FILE, [p.to_dict() for p in products])
+        elif SNAPSHOT_FILE and cache:
+            st = os.stat(PRODUCTS_FILE)
+            persister.mark(SNAPSHOT_FILE, lambda: write_snapshot(SNAPSHOT_FILE, products, st))
+        return products
+
+    def add_product(self, p):
+        p.id = self.product_ids.bump(floor=self.product_floor)
+        self.stock.set(p.id, p.stock)
+        self.log_change({"product": p.to_dict(), "new": True})
+
+    # Edits carry the listed fields only; ratings arrive as counts.
+    def save_product(self, p):
+        self.log_change({"product": p.to_dict()})
+
+    # hists: {pid: ratings per star}, already added to the catalog's records
+    def add_ratings(self, hists):
+        self.log_change({"rate": hists})
+
+    def delete_product(self, pid):
+        self.stock.set(int(pid), None)
+        self.log_change({"delete": int(pid)})
+
+    # the admin's stock figure replaces the live level
+    def set_stock(self, p):
+        self.stock.set(p.id, p.stock)
+        shared_version.bump()
+
+    def log_change(self, record):
+        record["by"] = os.getpid()
+        self.product_log.append(record)
+        persister.mark(PRODUCTS_LOG, self.product_log.sync)
+        if self.product_log.size() >= PRODUCTS_LOG_MAX:
+            persister.mark(PRODUCTS_FILE, self.fold)
+        shared_version.bump()
+
+    EDITED = ("name", "price", "img", "category", "featured")
+
+    # Apply logged changes to a catalog. Ratings logged by this process are
+    # skipped unless replaying from scratch (own=None): its records have them.
+    def apply_changes(self, catalog, records, own=None):
+        for record in records:
+            if "rate" in record:
+                if record.get("by") == own:
+                    continue
+                for pid, hist in record["rate"].items():
+                    p = catalog.get(pid)
+                    if p is not None:
+                        catalog.rate_many(p, hist)
+            elif "product" in record:
+                d = record["product"]
+                p = catalog.get(d["id"])
+                if p is not None:
+                    fields = {name: d[name] for name in self.EDITED if getattr(p, name) != d[name]}
+                    if fields:
+                        catalog.update(p, **fields)
+                elif record.get("new"):
+                    p = Product.from_dict(d)
+                    p.stock = self.stock.get(p.id)
+                    catalog.add(p)
+            elif "delete" in record:
+                catalog.remove(record["delete"])
+
+    # Fold the log into products.json. Appends wait on the exclusive lock
+    # meanwhile. The old log is renamed aside before the new products.json
+    # goes in, so a fold cut short is finished (or dropped) by finish_fold.
+    def fold(self):
+        log = self.product_log
+        with log.lock, log.locked(fcntl.LOCK_EX):
+            try:
+                if os.path.getsize(PRODUCTS_LOG) < PRODUCTS_LOG_MAX:
+                    return      # another worker folded it
+            except FileNotFoundError:
+                return
+            self.finish_fold()
+            products = Catalog(self.read_products(cache=False))
+            self.apply_changes(products, log.read_from()[0])
+            products = products.to_list()
+            for p in products:
+                p.stock = self.stock.get(p.id)
+            save_json(PRODUCTS_FILE + ".folded", [p.to_dict() for p in products])
+            os.rename(PRODUCTS_LOG, PRODUCTS_LOG + ".old")
+            self.finish_fold()
+            log.open()
+            if SNAPSHOT_FILE:
+                write_snapshot(SNAPSHOT_FILE, products, os.stat(PRODUCTS_FILE))
+        shared_version.bump()
+
+    # Caller holds the log's exclusive lock. With the old log set aside the
+    # folded products.json holds its changes, so it goes in (unless already
+    # in) and the old log goes; without, a leftover fold never counted.
+    @staticmethod
+    def finish_fold():
+        if os.path.exists(PRODUCTS_LOG + ".old"):
+            if os.path.exists(PRODUCTS_FILE + ".folded"):
+                os.replace(PRODUCTS_FILE + ".folded", PRODUCTS_FILE)
+            os.unlink(PRODUCTS_LOG + ".old")
+        elif os.path.exists(PRODUCTS_FILE + ".folded"):
+            os.unlink(PRODUCTS_FILE + ".folded")
+
+    # Live units left, or None if untracked. Records only see this
+    # worker's sales, the shared file every worker's; reading it is a
+    # memory load.
+    def stock_level(self, p):
+        return self.stock.get(p.id)
+
+    # Apply the product changes other workers logged since the last call.
+    # After a fold the log starts over, so everything is read back and
+    # only the records that differ are swapped in.
+    def refresh(self, catalog):
+        if shared_version.read() == self.seen_version:
+            return
+        with self.refresh_lock:
+            version = shared_version.read()
+            if version == self.seen_version:
+                return
+            # remember the version before reading, so a write racing this
+            # refresh is picked up by the next one
+            self.seen_version = version
+            records, cursor, restarted = self.product_log.read_after(self.log_cursor)
+            if not restarted:
+                with catalog.lock:
+                    self.apply_changes(catalog, records, own=os.getpid())
+                self.log_cursor = cursor
+                return
+            products, self.log_cursor = self.read_state()
+            changed = [p for p in products if product_state(catalog.get(p.id)) != product_state(p)]
+            live = {p.id for p in products}
+            with catalog.lock:
+                for p in changed:
+                    p.stock = self.stock.get(p.id)
+                    catalog.put(p)
+                for p in catalog.to_list():
+                    if p.id not in live:
+                        catalog.remove(p.id)
+    # Cached, but revalidated with a stat: every write replaces the file, so
+    # another worker's change shows up as a new inode and mtime.
+    def get_user(self, username):
+        if not username:
+            return None
+        path = user_path(username)
+        try:
+            st = os.stat(path)
+            stamp = (st.st_ino, st.st_mtime_ns)
+            cached = self.users_by_name.get(username)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+            with open(path, "r", encoding="utf-8") as f:
+                user = load_user(json.load(f))
+        except (OSError, ValueError):
+            self.users_by_name.pop(username, None)
+            return None
+        self.users_by_name[username] = (stamp, user)
+        return user
+
+    # Written synchronously, so a taken name is seen by every worker.
+    def add_user(self, user):
+        return create_exclusive(user_path(user["username"]), user_record(user))
+
+    # Apply change(user) to the stored user and write it back, with the
+    # file's directory locked (lockf across workers, a thread lock within
+    # one), so concurrent changes from different workers all land.
+    # Returns the updated user, or None if there is no such user.
+    def update_user(self, username, change):
+        path = user_path(username)
+        with self.user_locked(os.path.dirname(path)):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    user = load_user(json.load(f))
+            except (OSError, ValueError):
+                return None
+            change(user)
+            save_json(path, user_record(user))
+        return user
+
+    @contextmanager
+    def user_locked(self, folder):
+        lock = self.user_locks.get(folder)
+        if lock is None:
+            lock = self.user_locks.setdefault(folder, threading.Lock())
+        with lock:
+            fd = os.open(os.path.join(folder, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def all_users(self):
+        for root, _, names in os.walk(USERS_DIR):
+            for name in names:
+                if name.endswith(".json"):
+                    with open(os.path.join(root, name), "r", encoding="utf-8") as f:
+                        yield load_user(json.load(f))
+
+    def load_orders(self):
+        if not os.path.exists(ORDERS_JOURNAL) and os.path.exists(ORDERS_FILE):
+            self.import_orders()
+        items, offset, inode = order_journal.read_from()
+        self.order_cursor = self.index_cursor = (inode, offset)
+        # Order ids come from the shared counter one at a time, so they are
+        # unique and increase across workers in the order checkouts took them.
+        self.order_ids = SharedCounter(ORDER_IDS_FILE)
+        self.order_floor = max((o["id"] for o in items), default=0)
+        self.order_index = OrderIndex(items)
+        self.order_lock = threading.Lock()
+        return items
+
+    # One-time move from orders.json to the journal. Built in a temp file
+    # and linked into place, so workers importing at the same time leave
+    # exactly one complete journal, and none of them reads a partial one.
+    @staticmethod
+    def import_orders():
+        tmp = "%s.%d.tmp" % (ORDERS_JOURNAL, os.getpid())
+        with open(tmp, "w", encoding="utf-8") as f:
+            for order in load_json(ORDERS_FILE, DEFAULT_ORDERS):
+                f.write(json.dumps(order, ensure_ascii=False, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(tmp, ORDERS_JOURNAL)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp)
+
+    def order_history(self, user=None, after=None, limit=PAGE_SIZE):
+        self.catch_up_orders()
+        return self.order_index.page(user, after, limit)
+
+    # Index orders other workers appended since the last look.
+    def catch_up_orders(self):
+        with self.order_lock:
+            records, self.index_cursor, _ = self.orders_after(self.index_cursor)
+            for order in records:
+                self.order_index.add(order)
+
+    # Orders any worker appended to the journal after cursor: (orders, new
+    # cursor, whether they are the whole journal again).
+    @staticmethod
+    def orders_after(cursor):
+        return order_journal.read_after(cursor)
+
+    # Assigns order["id"] and stores the order, unless key was already used
+    # for one or a product is short. Returns (order id, whether this call
+    # placed it, units left per tracked product); when short, the id is
+    # None and the units left are those of the short products. Stock and
+    # the key are claimed first and handed back if the order isn't written.
+    def place_order(self, order, key=None):
+        reserved, stock = self.stock.reserve(order["items"])
+        if not reserved:
+            return None, False, stock
+        claimed = False
+        try:
+            order["id"] = self.order_ids.bump(floor=self.order_floor)
+            claimed = key is None or create_exclusive(self.key_path(key), order["id"])
+            if claimed:
+                order_journal.append(order)
+        except Exception:
+            if claimed and key:
+                os.unlink(self.key_path(key))
+            self.stock.release(order["items"])
+            raise
+        if not claimed:
+            self.stock.release(order["items"])
+            return self.checkout_order(key), False, {}
+        sync_orders()
+        self.order_index.add(order)
+        return order["id"], True, stock
+
+    @staticmethod
+    def key_path(key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+        return os.path.join(CHECKOUT_KEYS_DIR, digest[:2], digest)
+
+    def checkout_order(self, key):
+        try:
+            with open(self.key_path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def expire_checkout_keys(self, ttl):
+        expired, cutoff = 0, time.time() - ttl
+        for root, _, names in os.walk(CHECKOUT_KEYS_DIR):
+            for name in names:
+                path = os.path.join(root, name)
+                if not name.endswith(".tmp") and os.stat(path).st_mtime < cutoff:
+                    os.unlink(path)
+                    expired += 1
+        return expired
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    price INTEGER NOT NULL,
+    category TEXT NOT NULL,
+    featured INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL,
+    stock INTEGER
+);
+CREATE INDEX IF NOT EXISTS products_category ON products (category, featured);
+CREATE INDEX IF NOT EXISTS products_price ON products (price);
+
+CREATE TABLE IF NOT EXISTS product_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    pid INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY,
+    user TEXT,
+    created_at TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orders_user ON orders (user, id);
+
+CREATE TABLE IF NOT EXISTS checkout_keys (
+    key TEXT PRIMARY KEY,
+    order_id INTEGER NOT NULL,
+    created REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+# One connection per thread (and per process after a gunicorn fork). The
+# sqlite3 module caches prepared statements per connection, so fixed SQL
+# strings are compiled once per connection.
+def thread_connection(local, path):
+    conn = getattr(local, "conn", None)
+    if conn is None or local.pid != os.getpid():
+        conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, cached_statements=64)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        local.conn = conn
+        local.pid = os.getpid()
+    return conn
+
+
+# Product writes also log the id in product_changes and bump the shared
+# version; other workers notice the bump on their next request and reload
+# only the logged products.
+class SqliteStorage:
+    CHANGES_KEPT = 10000
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.conn().executescript(SQLITE_SCHEMA)
+        if "stock" not in {row[1] for row in self.conn().execute("PRAGMA table_info(products)")}:
+            self.conn().execute("ALTER TABLE products ADD COLUMN stock INTEGER")
+        self.refresh_lock = threading.Lock()
+        self.seen_version = shared_version.read()
+        self.seen_seq = self.conn().execute("SELECT COALESCE(MAX(seq), 0) FROM product_changes").fetchone()[0]
+
+    def conn(self):
+        return thread_connection(self.local, self.path)
+
+    @staticmethod
+    def product_row(p):
+        return (p.id, p.name, p.price, p.category, int(p.featured), json.dumps(p.to_dict(), ensure_ascii=False), p.stock)
+
+    # the stock column is the live level; the copy in data is not kept up to date
+    @staticmethod
+    def row_product(data, stock):
+        p = Product.from_dict(json.loads(data))
+        p.stock = stock
+        return p
+
+    @staticmethod
+    def order_row(o):
+        return (o["id"], o.get("user"), o["created_at"], json.dumps(o, ensure_ascii=False))
+
+    def load_products(self):
+        return [self.row_product(*row) for row in self.conn().execute("SELECT data, stock FROM products ORDER BY id")]
+
+    # SQLite picks the id, so products added by two workers at once never share one.
+    def add_product(self, p):
+        conn = self.conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            p.id = conn.execute(
+                "INSERT INTO products (name, price, category, featured, data, stock) VALUES (?, ?, ?, ?, '', ?)",
+                (p.name, p.price, p.category, int(p.featured), p.stock)
+            ).lastrowid
+            conn.execute("UPDATE products SET data = ? WHERE id = ?", (json.dumps(p.to_dict(), ensure_ascii=False), p.id))
+            self.log_change(conn, p.id)
+        shared_version.bump()
+
+    # Ratings only change through add_ratings, so an edit keeps the stored
+    # aggregate rather than this worker's copy of it. A product deleted
+    # meanwhile stays deleted.
+    def save_product(self, p):
+        data = p.to_dict()
+        conn = self.conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT data FROM products WHERE id = ?", (p.id,)).fetchone()
+            if row is None:
+                return
+            data["rating"] = json.loads(row[0])["rating"]
+            conn.execute(
+                "UPDATE products SET name = ?, price = ?, category = ?, featured = ?, data = ? WHERE id = ?",
+                (p.name, p.price, p.category, int(p.featured), json.dumps(data, ensure_ascii=False), p.id)
+            )
+            self.log_change(conn, p.id)
+        shared_version.bump()
+
+    # Ratings are added to the stored aggregate inside the write
+    # transaction, so every worker's ratings count; the workers' records
+    # pick up the sums on their next refresh. One transaction, and one
+    # version bump, for the lot.
+    def add_ratings(self, hists):
+        conn = self.conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for pid, hist in hists.items():
+                row = conn.execute("SELECT data FROM products WHERE id = ?", (pid,)).fetchone()
+                if row is None:
+                    continue
+                p = Product.from_dict(json.loads(row[0]))
+                p.add_ratings(hist)
+                conn.execute("UPDATE products SET data = ? WHERE id = ?", (json.dumps(p.to_dict(), ensure_ascii=False), pid))
+                self.log_change(conn, pid)
+        shared_version.bump()
+
+    # the stock column reaches every worker's records through refresh()
+    @staticmethod
+    def stock_level(p):
+        return p.stock
+
+    # Kept out of save_product, so saving an edit from a worker that
+    # hasn't seen the latest sales can't put sold units back.
+    def set_stock(self, p):
+        conn = self.conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("UPDATE products SET stock = ? WHERE id = ?", (p.stock, p.id))
+            self.log_change(conn, p.id)
+        shared_version.bump()
+
+    def delete_product(self, pid):
+        conn = self.conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM products WHERE id = ?", (int(pid),))
+            self.log_change(conn, pid)
+        shared_version.bump()
+
+    def log_change(self, conn, pid):
+        seq = conn.execute("INSERT INTO product_changes (pid) VALUES (?)", (int(pid),)).lastrowid
+        if seq % 1000 == 0:
+            conn.execute("DELETE FROM product_changes WHERE seq <= ?", (seq - self.CHANGES_KEPT,))
+
+    # Apply product changes made by other workers since the last call.
+    # Other requests wait for a refresh in progress rather than run on the
+    # records it is replacing.
+    def refresh(self, catalog):
+        if shared_version.read() == self.seen_version:
+            return
+        with self.refresh_lock:
+            version = shared_version.read()
+            if version == self.seen_version:
+                return
+            # remember the version before reading, so a write racing this
+            # refresh is picked up by the next one
+            self.seen_version = version
+            conn = self.conn()
+            rows = conn.execute("SELECT seq, pid FROM product_changes WHERE seq > ? ORDER BY seq",
+                                (self.seen_seq,)).fetchall()
+            if not rows:
+                return
+            if rows[0][0] > self.seen_seq + 1 and self.seen_seq:
+                # fell behind the pruned log: reload everything
+                products = self.load_products()
+                with catalog.lock:
+                    for p in catalog.to_list():
+                        catalog.remove(p.id)
+                    for p in products:
+                        catalog.add(p)
+            else:
+                pids = list({pid for _, pid in rows})
+                found = {}
+                for i in range(0, len(pids), 500):
+                    chunk = pids[i:i + 500]
+                    sql = "SELECT id, data, stock FROM products WHERE id IN (%s)" % ",".join("?" * len(chunk))
+                    found.update((pid, (data, stock)) for pid, data, stock in conn.execute(sql, chunk))
+                with catalog.lock:
+                    for pid in pids:
+                        if pid not in found:
+                            catalog.remove(pid)
+                            continue
+                        p, old = self.row_product(*found[pid]), catalog.get(pid)
+                        if product_state(old) != product_state(p):
+                            catalog.put(p)
+                        elif old.stock != p.stock:
+                            # a sale: no index or cached page covers the stock
+                            catalog.update(old, stock=p.stock)
+            self.seen_seq = rows[-1][0]
+
+    def get_user(self, username):
+        row = self.conn().execute("SELECT data FROM users WHERE username = ?", (username,)).fetchone()
+        return load_user(json.loads(row[0])) if row else None
+
+    def add_user(self, user):
+        try:
+            self.conn().execute("INSERT INTO users (username, data) VALUES (?, ?)",
+                                (user["username"], json.dumps(user_record(user), ensure_ascii=False)))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    # read, change and write back in one write transaction
+    def update_user(self, username, change):
+        conn = self.conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT data FROM users WHERE username = ?", (username,)).fetchone()
+            if row is None:
+                return None
+            user = load_user(json.loads(row[0]))
+            change(user)
+            conn.execute("UPDATE users SET data = ? WHERE username = ?",
+                         (json.dumps(user_record(user), ensure_ascii=False), username))
+        return user
+
+    def load_orders(self):
+        rows = self.conn().execute("SELECT id, data FROM orders ORDER BY id").fetchall()
+        self.order_cursor = rows[-1][0] if rows else 0
+        return [json.loads(data) for _, data in rows]
+
+    # Orders any worker stored with ids after cursor; ids are assigned in
+    # commit order. Returns the same as JsonStorage.orders_after.
+    def orders_after(self, cursor):
+        rows = self.conn().execute("SELECT id, data FROM orders WHERE id > ? ORDER BY id", (cursor,)).fetchall()
+        return [json.loads(data) for _, data in rows], rows[-1][0] if rows else cursor, False
+
+    # The write transaction serialises checkouts across workers, so the id,
+    # the key and the stock are claimed together. Returns the same as
+    # JsonStorage.place_order.
+    def place_order(self, order, key=None):
+        conn = self.conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if key:
+                row = conn.execute("SELECT order_id FROM checkout_keys WHERE key = ?", (key,)).fetchone()
+                if row:
+                    return row[0], False, {}
+            stock = {}
+            for pid, qty in order["items"].items():
+                row = conn.execute("SELECT stock FROM products WHERE id = ?", (int(pid),)).fetchone()
+                if row and row[0] is not None:
+                    stock[int(pid)] = (row[0], qty)
+            short = {pid: n for pid, (n, qty) in stock.items() if n < qty}
+            if short:
+                return None, False, short
+            for pid, (n, qty) in stock.items():
+                conn.execute("UPDATE products SET stock = stock - ? WHERE id = ? AND stock >= ?", (qty, pid, qty))
+                self.log_change(conn, pid)
+            order["id"] = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM orders").fetchone()[0]
+            conn.execute("INSERT INTO orders (id, user, created_at, data) VALUES (?, ?, ?, ?)", self.order_row(order))
+            if key:
+                conn.execute("INSERT INTO checkout_keys (key, order_id, created) VALUES (?, ?, ?)",
+                             (key, order["id"], time.time()))
+        if stock:
+            shared_version.bump()
+        return order["id"], True, {pid: n - qty for pid, (n, qty) in stock.items()}
+
+    # newest first, keyset on id; uses orders_user for one user's history
+    def order_history(self, user=None, after=None, limit=PAGE_SIZE):
+        after = (1 << 63) - 1 if after is None else after
+        if user is None:
+            rows = self.conn().execute("SELECT data FROM orders WHERE id < ? ORDER BY id DESC LIMIT ?", (after, limit))
+        else:
+            rows = self.conn().execute("SELECT data FROM orders WHERE user = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                                       (user, after, limit))
+        return [json.loads(data) for data, in rows]
+
+    def checkout_order(self, key):
+        row = self.conn().execute("SELECT order_id FROM checkout_keys WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def expire_checkout_keys(self, ttl):
+        return self.conn().execute("DELETE FROM checkout_keys WHERE created < ?", (time.time() - ttl,)).rowcount
+
+    # One-shot copy from the JSON files; existing rows with the same key are replaced.
+    def import_from(self, source):
+        products, users, orders = source.load_products(), list(source.all_users()), source.load_orders()
+        conn = self.conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT OR REPLACE INTO products (id, name, price, category, featured, data, stock) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)", map(self.product_row, products))
+            conn.executemany("INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)",
+                             ((u["username"], json.dumps(user_record(u), ensure_ascii=False)) for u in users))
+            conn.executemany("INSERT OR REPLACE INTO orders (id, user, created_at, data) VALUES (?, ?, ?, ?)",
+                             map(self.order_row, orders))
+        return len(products), len(users), len(orders)
+
+
+storage = SqliteStorage(SQLITE_PATH) if STORAGE == "sqlite" else JsonStorage()
+# only seeds the order-derived indexes at startup and is dropped after them;
+# the storage answers order queries, so placed orders are not kept here
+orders = storage.load_orders()
+
+
+# -------------------- CART STORE --------------------
+# Carts are {str(pid): qty} dicts to the routes. Server-side stores keep
+# them packed as one int32 array of pid, qty pairs.
+def pack_cart(cart):
+    return array("i", [n for pid, qty in cart.items() for n in (int(pid), qty)])
+
+
+def unpack_cart(packed):
+    return {str(packed[i]): packed[i + 1] for i in range(0, len(packed), 2)}
+
+
+class SessionCartStore:
+    def load(self):
+        return session.get("cart", {})
+
+    def save(self, cart):
+        session["cart"] = cart
+        session.modified = True
+
+    def clear(self):
+        session.pop("cart", None)
+
+    def stats(self):
+        return {"store": "session"}
+
+
+# The cookie only carries an opaque cart id, set once; cart mutations
+# don't touch the session, so Flask doesn't re-sign or resend it.
+class ServerCartStore:
+    def cart_id(self, create=False):
+        sid = session.get("cart_id")
+        if sid is None and create:
+            sid = session["cart_id"] = secrets.token_urlsafe(16)
+        return sid
+
+    def load(self):
+        sid = self.cart_id()
+        packed = self.get(sid) if sid else None
+        return unpack_cart(packed) if packed else {}
+
+    def save(self, cart):
+        if cart:
+            self.put(self.cart_id(create=True), pack_cart(cart))
+        else:
+            self.clear()
+
+    def clear(self):
+        sid = self.cart_id()
+        if sid:
+            self.delete(sid)
+
+
+# LRU ordered: touching a cart moves it to the end, so both expired carts
+# and eviction victims are taken from the front.
+class MemoryCartStore(ServerCartStore):
+    ENTRY_OVERHEAD = 200    # key, tuple and dict slot, roughly
+
+    def __init__(self, ttl, budget):
+        self.ttl = ttl
+        self.budget = budget
+        self.carts = OrderedDict()      # sid -> (expires_at, packed)
+        self.bytes = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def size(self, packed):
+        return self.ENTRY_OVERHEAD + packed.itemsize * len(packed)
+
+    def get(self, sid):
+        with self.lock:
+            entry = self.carts.get(sid)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self.drop(sid)
+                return None
+            self.carts[sid] = (time.time() + self.ttl, entry[1])
+            self.carts.move_to_end(sid)
+            return entry[1]
+
+    def put(self, sid, packed):
+        with self.lock:
+            self.drop(sid)
+            self.carts[sid] = (time.time() + self.ttl, packed)
+            self.bytes += self.size(packed)
+            now = time.time()
+            while self.carts:
+                oldest, (expires, _) = next(iter(self.carts.items()))
+                if expires >= now and self.bytes <= self.budget:
+                    break
+                self.drop(oldest)
+                self.evicted += 1
+
+    def delete(self, sid):
+        with self.lock:
+            self.drop(sid)
+
+    def drop(self, sid):
+        entry = self.carts.pop(sid, None)
+        if entry is not None:
+            self.bytes -= self.size(entry[1])
+
+    def stats(self):
+        return {"store": "memory", "carts": len(self.carts), "bytes": self.bytes,
+                "budget": self.budget, "evicted": self.evicted}
+
+
+class SqliteCartStore(ServerCartStore):
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.local = threading.local()
+        self.writes = 0
+        self.conn().execute(
+            "CREATE TABLE IF NOT EXISTS carts (sid TEXT PRIMARY KEY, expires REAL NOT NULL, data BLOB NOT NULL) WITHOUT ROWID"
+        )
+
+    def conn(self):
+        return thread_connection(self.local, self.path)
+
+    def get(self, sid):
+        row = self.conn().execute("SELECT data FROM carts WHERE sid = ? AND expires >= ?", (sid, time.time())).fetchone()
+        if row is None:
+            return None
+        packed = array("i")
+        packed.frombytes(row[0])
+        return packed
+
+    def put(self, sid, packed):
+        conn = self.conn()
+        conn.execute("INSERT OR REPLACE INTO carts (sid, expires, data) VALUES (?, ?, ?)",
+                     (sid, time.time() + self.ttl, packed.tobytes()))
+        self.writes += 1
+        if self.writes % 1000 == 0:
+            conn.execute("DELETE FROM carts WHERE expires < ?", (time.time(),))
+
+    def delete(self, sid):
+        self.conn().execute("DELETE FROM carts WHERE sid = ?", (sid,))
+
+    def stats(self):
+        return {"store": "sqlite", "carts": self.conn().execute("SELECT COUNT(*) FROM carts").fetchone()[0]}
+
+
+if CART_STORE == "memory":
+    cart_store = MemoryCartStore(CART_TTL, CART_MEMORY_BUDGET)
+elif CART_STORE == "sqlite":
+    cart_store = SqliteCartStore(CART_DB, CART_TTL)
+else:
+    cart_store = SessionCartStore()
+
+
+# -------------------- SEARCH --------------------
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    text = (text or "").casefold()
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return TOKEN_RE.findall(text)
+
+
+# Inverted index over name + category, ranked with BM25.
+# Every query token matches as a prefix; exact term hits score higher.
+# Recent results are cached until the next mutation.
+class SearchIndex:
+    FIELDS = {"name", "category"}
+    K1 = 1.2
+    B = 0.75
+    PREFIX_WEIGHT = 0.5
+    CACHE_SIZE = 256
+
+    def __init__(self):
+        self.postings = {}      # term -> {pid: tf}; emptied terms are kept
+        self.terms = []         # sorted vocabulary for prefix lookups
+        self.new_terms = []     # sorted, merged into self.terms in batches
+        self.doc_terms = {}     # pid -> Counter of its terms
+        self.doc_len = {}
+        self.total_len = 0
+        self.cache = OrderedDict()
+
+    def add(self, p):
+        pid = p.id
+        self.cache.clear()
+        tf = Counter(tokenize(p.name) + tokenize(p.category))
+        self.doc_terms[pid] = tf
+        self.doc_len[pid] = sum(tf.values())
+        self.total_len += self.doc_len[pid]
+        for term, n in tf.items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = {}
+                bisect.insort(self.new_terms, term)
+            posting[pid] = n
+        if len(self.new_terms) > max(1024, len(self.terms) // 8):
+            self.terms = sorted(self.terms + self.new_terms)
+            self.new_terms = []
+
+    def remove(self, p):
+        pid = p.id
+        tf = self.doc_terms.pop(pid, None)
+        if tf is None:
+            return
+        self.cache.clear()
+        self.total_len -= self.doc_len.pop(pid)
+        for term in tf:
+            self.postings[term].pop(pid, None)
+
+    def expand(self, token):
+        found = []
+        for terms in (self.terms, self.new_terms):
+            lo = bisect.bisect_left(terms, token)
+            hi = bisect.bisect_left(terms, token + "\U0010ffff", lo)
+            found.extend(t for t in terms[lo:hi] if self.postings[t])
+        return found
+
+    def search(self, q):
+        key = " ".join(tokenize(q))
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        result = self.cache[key] = self.rank(key.split())
+        if len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return result
+
+    def rank(self, tokens):
+        n_docs = len(self.doc_len)
+        if not tokens or not n_docs:
+            return []
+
+        # match every token (AND), most selective first
+        matches = []
+        for token in set(tokens):
+            terms = self.expand(token)
+            if not terms:
+                return []
+            matches.append((sum(len(self.postings[t]) for t in terms), token, terms))
+        matches.sort()
+
+        candidates = None
+        for _, _, terms in matches:
+            if len(terms) == 1:
+                hit = self.postings[terms[0]].keys()
+            else:
+                hit = set()
+                for t in terms:
+                    hit.update(self.postings[t])
+            candidates = set(hit) if candidates is None else candidates.intersection(hit)
+            if not candidates:
+                return []
+
+        k1, b = self.K1, self.B
+        avg_len = self.total_len / n_docs
+        doc_len = self.doc_len
+        scores = dict.fromkeys(candidates, 0.0)
+        for _, token, terms in matches:
+            for t in terms:
+                posting = self.postings[t]
+                idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+                weight = (idf if t == token else idf * self.PREFIX_WEIGHT) * (k1 + 1)
+                hits = candidates.intersection(posting) if len(posting) > len(candidates) else \
+                    [pid for pid in posting if pid in candidates]
+                for pid in hits:
+                    tf = posting[pid]
+                    scores[pid] += weight * tf / (tf + k1 * (1 - b + b * doc_len[pid] / avg_len))
+
+        return sorted(scores, key=scores.__getitem__, reverse=True)
+
+
+# -------------------- SUGGEST --------------------
+# Typeahead over product names and categories. Every word start of a phrase
+# is a sorted key ("mousepad xl\0gaming mousepad xl"), so "mou" completes
+# "Gaming Mousepad XL". Phrases are weighted by rating count + units sold.
+class Suggester:
+    FIELDS = {"name", "category", "rating", "sales"}
+    TOP_K = 8
+    CACHE_SIZE = 1024
+
+    def __init__(self, sales=()):
+        self.sales = Counter(sales)     # pid -> units ordered
+        self.linked = {}                # pid -> (phrase keys, weight)
+        self.phrases = {}               # phrase key -> [display text, weight, products]
+        self.keys = []
+        self.new_keys = []
+        self.cache = OrderedDict()
+
+    def popularity(self, p):
+        return 1 + p.rating_count + self.sales[p.id]
+
+    def add(self, p):
+        w = self.popularity(p)
+        keys = [self.link(p.name, w), self.link(p.category, w)]
+        self.linked[p.id] = (keys, w)
+
+    def remove(self, p):
+        entry = self.linked.pop(p.id, None)
+        if entry is None:
+            return
+        keys, w = entry
+        for key in keys:
+            if key is not None:
+                phrase = self.phrases[key]
+                phrase[1] -= w
+                phrase[2] -= 1
+                self.invalidate(key)
+
+    # drop cached prefixes that could list this phrase
+    def invalidate(self, key):
+        if not self.cache:
+            return
+        words = key.split(" ")
+        for i in range(len(words)):
+            tail = " ".join(words[i:])
+            for n in range(1, len(tail) + 1):
+                self.cache.pop(tail[:n], None)
+
+    def link(self, text, w):
+        words = tokenize(text)
+        if not words:
+            return None
+        key = " ".join(words)
+        phrase = self.phrases.get(key)
+        if phrase is None:
+            phrase = self.phrases[key] = [text, 0, 0]
+            for i in range(len(words)):
+                bisect.insort(self.new_keys, " ".join(words[i:]) + "\0" + key)
+            if len(self.new_keys) > max(1024, len(self.keys) // 8):
+                self.keys = sorted(self.keys + self.new_keys)
+                self.new_keys = []
+        phrase[1] += w
+        phrase[2] += 1
+        self.invalidate(key)
+        return key
+
+    # run through catalog.change(p, ["sales"], ...), which re-links p
+    def record_sale(self, p, qty):
+        self.sales[p.id] += qty
+
+    def suggest(self, q):
+        prefix = " ".join(tokenize(q))
+        if q[-1:].isspace() and prefix:
+            prefix += " "
+        if prefix in self.cache:
+            self.cache.move_to_end(prefix)
+            return self.cache[prefix]
+
+        found = set()
+        for keys in (self.keys, self.new_keys):
+            lo = bisect.bisect_left(keys, prefix)
+            hi = bisect.bisect_left(keys, prefix + "\U0010ffff", lo)
+            found.update(k.rpartition("\0")[2] for k in keys[lo:hi])
+        live = [self.phrases[k] for k in found if self.phrases[k][2] > 0]
+        result = [text for text, _, _ in heapq.nlargest(self.TOP_K, live, key=lambda ph: ph[1])] if prefix else []
+
+        self.cache[prefix] = result
+        if len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return result
+
+
+# -------------------- FACETS --------------------
+# Posting sets per category and for featured products. The sorted category
+# list (with counts) is rebuilt lazily after an admin mutation.
+class FacetIndex:
+    FIELDS = {"category", "featured"}
+
+    def __init__(self):
+        self.by_category = {}
+        self.featured = set()
+        self.category_list = None
+
+    def add(self, p):
+        self.by_category.setdefault(p.category, set()).add(p.id)
+        if p.featured:
+            self.featured.add(p.id)
+        self.category_list = None
+
+    def remove(self, p):
+        ids = self.by_category.get(p.category)
+        if ids is not None:
+            ids.discard(p.id)
+            if not ids:
+                del self.by_category[p.category]
+        self.featured.discard(p.id)
+        self.category_list = None
+
+    def categories(self):
+        if self.category_list is None:
+            self.category_list = sorted((c, len(ids)) for c, ids in self.by_category.items())
+        return self.category_list
+
+    # ids matching every given facet, or None when no facet is set
+    def filter(self, category="", featured=False):
+        sets = []
+        if category:
+            sets.append(self.by_category.get(category, set()))
+        if featured:
+            sets.append(self.featured)
+        if not sets:
+            return None
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+
+# -------------------- SORTED INDEXES --------------------
+# (key, pid) pairs kept in order with bisect, for range queries and sorting.
+# Bulk loads append unsorted; the list is sorted once on first use.
+class SortedIndex:
+    def __init__(self, key, fields):
+        self.key = key
+        self.FIELDS = set(fields)
+        self.entries = []
+        self.sort_keys = {}     # pid -> key the product was indexed under
+        self.dirty = True
+
+    def add(self, p):
+        entry = (self.key(p), p.id)
+        self.sort_keys[p.id] = entry
+        if self.dirty:
+            self.entries.append(entry)
+        else:
+            bisect.insort(self.entries, entry)
+
+    def remove(self, p):
+        entry = self.sort_keys.pop(p.id, None)
+        if entry is None:
+            return
+        self.ensure_sorted()
+        del self.entries[bisect.bisect_left(self.entries, entry)]
+
+    def ensure_sorted(self):
+        if self.dirty:
+            self.entries.sort()
+            self.dirty = False
+        return self.entries
+
+    def bounds(self, lo=None, hi=None):
+        return key_bounds(self.ensure_sorted(), lo, hi)
+
+    def ids(self, start, end):
+        return {pid for _, pid in self.entries[start:end]}
+
+
+# entries[start:end] have lo <= key <= hi
+def key_bounds(entries, lo=None, hi=None):
+    start = 0 if lo is None else bisect.bisect_left(entries, (lo,))
+    end = len(entries) if hi is None else bisect.bisect_left(entries, (hi, math.inf), start)
+    return start, end
+
+
+# -------------------- PAGE CACHE --------------------
+# LRU of rendered content fragments (the per-user layout around them is
+# rendered on every request). Entries carry tags; as a catalog index it
+# drops the product page of whatever changed and every listing page.
+class PageCache:
+    FIELDS = {"name", "price", "img", "category", "featured", "rating"}
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()    # key -> (html, tags)
+        self.tagged = {}                # tag -> keys
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def fetch(self, key, tags, render):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[0]
+            self.stats["misses"] += 1
+        version = catalog.version
+        html = Markup(render())
+        if self.max_bytes and catalog.version == version:
+            self.store(key, html, tags)
+        return html
+
+    def store(self, key, html, tags):
+        with self.lock:
+            self.drop(key)
+            self.entries[key] = (html, tags)
+            self.bytes += len(html)
+            for tag in tags:
+                self.tagged.setdefault(tag, set()).add(key)
+            while self.bytes > self.max_bytes and self.entries:
+                self.drop(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        html, tags = entry
+        self.bytes -= len(html)
+        for tag in tags:
+            keys = self.tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tagged[tag]
+
+    def invalidate(self, tag):
+        with self.lock:
+            keys = self.tagged.pop(tag, ())
+            for key in list(keys):
+                self.drop(key)
+            self.stats["invalidations"] += len(keys)
+
+    def add(self, p):
+        if self.entries:
+            self.invalidate(("product", p.id))
+            self.invalidate("listing")
+
+    remove = add
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), bytes=self.bytes, max_bytes=self.max_bytes)
+
+
+# -------------------- CATALOG --------------------
+# Product records keyed by id (dict keeps insertion order, so listing order is unchanged).
+# Secondary indexes get add/remove callbacks on every mutation; update() and
+# rate() only notify indexes whose FIELDS cover what changed. Lazy indexes
+# are filled on their first use(), so startup doesn't pay for them. The fill
+# runs outside the lock (listings don't wait for the first search); products
+# changed meanwhile are re-added before the index goes live.
+# Mutations hold the lock, and so does anything reading several index
+# structures at once (queries, search and suggest with their caches), so
+# no one sees a product between its remove and its re-add.
+class Catalog:
+    def __init__(self, items, indexes=(), lazy=()):
+        self.by_id = {}
+        self.version = 0        # bumped on every local change
+        self.indexes = list(indexes)
+        self.lazy = list(lazy)
+        self.lock = threading.RLock()
+        self.build_lock = threading.Lock()
+        self.changed = None     # pid -> product, while a lazy index fills
+        for p in items:
+            self.add(p)
+
+    def use(self, index):
+        if index in self.lazy:
+            with self.build_lock:
+                if index in self.lazy:
+                    self.build(index)
+        return index
+
+    def build(self, index):
+        with self.lock:
+            items = list(self.by_id.values())
+            self.changed = {}
+        with gc_paused():
+            for p in items:
+                index.add(p)
+        with self.lock:
+            # indexes remove by id, so a stale record is fine here
+            for pid, p in self.changed.items():
+                index.remove(p)
+                if pid in self.by_id:
+                    index.add(self.by_id[pid])
+            self.changed = None
+            self.indexes.append(index)
+            self.lazy.remove(index)
+
+    def touch(self, p):
+        if self.changed is not None:
+            self.changed[p.id] = p
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def get(self, pid):
+        try:
+            return self.by_id.get(int(pid))
+        except (TypeError, ValueError):
+            return None
+
+    def add(self, p):
+        with self.lock:
+            self.by_id[p.id] = p
+            self.version += 1
+            self.touch(p)
+            for index in self.indexes:
+                index.add(p)
+        return p
+
+    # insert or replace with a fresh record (e.g. loaded from another worker's write)
+    def put(self, p):
+        with self.lock:
+            old = self.by_id.get(p.id)
+            if old is not None:
+                for index in self.indexes:
+                    index.remove(old)
+            return self.add(p)
+
+    def touching(self, fields):
+        return [index for index in self.indexes if index.FIELDS & set(fields)]
+
+    # re-index p around change(p), for the indexes covering fields
+    def change(self, p, fields, change):
+        with self.lock:
+            touched = self.touching(fields)
+            for index in touched:
+                index.remove(p)
+            self.version += 1
+            self.touch(p)
+            change(p)
+            for index in touched:
+                index.add(p)
+        return p
+
+    def update(self, p, **fields):
+        return self.change(p, fields, lambda p: p.set(**fields))
+
+    def rate(self, p, rating):
+        return self.change(p, ["rating"], lambda p: p.add_rating(rating))
+
+    # a batch of ratings for one product, re-indexed once
+    def rate_many(self, p, hist):
+        return self.change(p, ["rating"], lambda p: p.add_ratings(hist))
+
+    def remove(self, pid):
+        with self.lock:
+            p = self.by_id.pop(int(pid), None)
+            if p is not None:
+                self.version += 1
+                self.touch(p)
+                for index in self.indexes:
+                    index.remove(p)
+        return p
+
+    def to_list(self):
+        return list(self.by_id.values())
+
+
+# Bulk loads allocate millions of objects without reference cycles; cyclic
+# collections during them would only rescan what was just built.
+@contextmanager
+def gc_paused():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def units_sold(orders):
+    sold = Counter()
+    for o in orders:
+        for pid, qty in o.get("items", {}).items():
+            sold[int(pid)] += qty
+    return sold
+
+
+search_index = SearchIndex()
+suggester = Suggester(units_sold(orders))
+facets = FacetIndex()
+price_index = SortedIndex(lambda p: p.price, ["price"])
+rating_index = SortedIndex(lambda p: p.bayesian_rating, ["rating"])
+newest_index = SortedIndex(lambda p: p.id, [])
+page_cache = PageCache(PAGE_CACHE_BYTES)
+with gc_paused():
+    catalog = Catalog(
+        storage.load_products(),
+        indexes=[facets, price_index, rating_index, newest_index, page_cache],
+        lazy=[search_index, suggester]
+    )
+# a fresh load may differ from what clients saw before the restart
+shared_version.bump()
+
+# sort name -> (index, descending)
+SORTS = {
+    "price": (price_index, False),
+    "rating": (rating_index, True),
+    "newest": (newest_index, True),
+}
+
+
+# bytes of rendered HTML per chunk when streaming ?all=1 listings
+STREAM_CHUNK = 16 * 1024
+
+
+# (key, pid) entries matching the home page filters, in display order,
+# starting right after the `after` entry (keyset pagination). Filters are
+# answered from the indexes and only the chosen ordering source is walked,
+# so seeking to a later page costs the same as the first one. Callers hold
+# catalog.lock while consuming the entries.
+def query_entries(q="", category="", featured=False, min_price=None, max_price=None, sort="", after=None):
+    filters = []
+    allowed = facets.filter(category, featured)
+    if allowed is not None:
+        filters.append(allowed)
+
+    priced = None
+    if min_price is not None or max_price is not None:
+        priced = price_index.bounds(min_price, max_price)
+
+    if q and sort not in SORTS:
+        # relevance order: the key is the rank position
+        ranked = catalog.use(search_index).search(q)
+        if priced is not None:
+            filters.append(price_index.ids(*priced))
+        start = min(int(after[0]) + 1, len(ranked)) if after else 0
+        source = ((i, ranked[i]) for i in range(start, len(ranked)))
+    else:
+        if q:
+            filters.append(set(catalog.use(search_index).search(q)))
+        index, reverse = SORTS.get(sort, (newest_index, False))
+        entries, start, end = index.ensure_sorted(), 0, len(index.entries)
+        if priced is not None:
+            if index is price_index:
+                start, end = priced
+            else:
+                filters.append(price_index.ids(*priced))
+        if filters and min(map(len, filters)) ** 2 < (end - start) * PAGE_SIZE:
+            # a filter so selective that walking the index to fill a page would
+            # cost more than sorting its candidates
+            entries = sorted(index.sort_keys[pid] for pid in min(filters, key=len))
+            start, end = key_bounds(entries, min_price, max_price) if index is price_index else (0, len(entries))
+        source = walk(entries, start, end, reverse, after)
+
+    if not filters:
+        return source
+    return (entry for entry in source if all(entry[1] in f for f in filters))
+
+
+def walk(entries, start, end, reverse, after):
+    if after is not None:
+        if reverse:
+            end = bisect.bisect_left(entries, after, start, end)
+        else:
+            start = bisect.bisect_right(entries, after, start, end)
+    positions = range(end - 1, start - 1, -1) if reverse else range(start, end)
+    return (entries[i] for i in positions)
+
+
+# a first search fills the index before the lock is taken, not under it
+def search_ready(filters):
+    if filters.get("q"):
+        catalog.use(search_index)
+
+
+def query_page(limit=PAGE_SIZE, **filters):
+    search_ready(filters)
+    with catalog.lock:
+        page = list(islice(query_entries(**filters), limit + 1))
+    cursor = format_cursor(page[limit - 1]) if len(page) > limit else None
+    return [pid for _, pid in page[:limit]], cursor
+
+
+# every matching id, taken under the lock since a stream outlives it
+def query_ids(**filters):
+    search_ready(filters)
+    with catalog.lock:
+        return array("q", (pid for _, pid in query_entries(**filters)))
+
+
+def format_cursor(entry):
+    return "%r:%d" % entry
+
+
+# None unless a sort key and id: keys are ranks, prices, ratings or ids,
+# all finite and never negative
+def parse_cursor(value):
+    try:
+        key, pid = value.split(":")
+        key, pid = float(key), int(pid)
+    except (AttributeError, ValueError):
+        return None
+    return (key, pid) if math.isfinite(key) and key >= 0 else None
+
+
+# -------------------- ORDER ANALYTICS --------------------
+# The order history as NumPy columns: one row per order (day, total, units)
+# and one per order line (quantity, revenue, and a key for the product and
+# its category at the time of sale). Checkout appends in place; columns
+# double when full, so the rows a report is reading are never written
+# again and reports work on views without copying. Aggregation is
+# bincount over those views instead of a loop over order dicts. Orders
+# from before prices were recorded use the current product price. Orders
+# are added from storage, every worker's alike, when a report asks for
+# them, so any worker gives the same answer.
+class OrderTable:
+    # index columns are intp and summed columns float64 (exact below 2**53),
+    # the types bincount works in, so reports don't convert 10M-row columns
+    ORDER_COLUMNS = {"day": np.int64, "total": np.float64, "units": np.int32} if np else {}
+    LINE_COLUMNS = {"key": np.int64, "qty": np.float64, "revenue": np.float64} if np else {}
+
+    def __init__(self, items=(), cursor=None):
+        self.lock = threading.Lock()
+        self.catch_up_lock = threading.Lock()
+        self.cursor = cursor        # storage position of the last order added
+        self.clear()
+        for order in items:
+            self.add(order)
+
+    def clear(self):
+        with self.lock:
+            self.orders = {name: np.zeros(1024, dtype) for name, dtype in self.ORDER_COLUMNS.items()}
+            self.lines = {name: np.zeros(1024, dtype) for name, dtype in self.LINE_COLUMNS.items()}
+            self.n_orders = self.n_lines = 0
+            self.keys = {}              # (pid, category code) -> line key
+            self.key_pid = array("q")
+            self.key_category = array("q")
+            self.categories = []        # category code -> name
+            self.category_codes = {}
+            self.days = {}              # "YYYY-MM-DD" -> date.toordinal()
+
+    def catch_up(self, storage):
+        with self.catch_up_lock:
+            records, self.cursor, restarted = storage.orders_after(self.cursor)
+            if restarted:
+                self.clear()
+            for order in records:
+                self.add(order)
+
+    def day(self, created_at):
+        key = created_at[:10]
+        if key not in self.days:
+            self.days[key] = date.fromisoformat(key).toordinal()
+        return self.days[key]
+
+    def line_key(self, pid, category):
+        code = self.category_codes.get(category)
+        if code is None:
+            code = self.category_codes[category] = len(self.categories)
+            self.categories.append(category)
+        key = self.keys.get((pid, code))
+        if key is None:
+            key = self.keys[(pid, code)] = len(self.key_pid)
+            self.key_pid.append(pid)
+            self.key_category.append(code)
+        return key
+
+    @staticmethod
+    def append(columns, n, row):
+        if n == len(next(iter(columns.values()))):
+            for name, col in columns.items():
+                columns[name] = grown = np.zeros(2 * n, col.dtype)
+                grown[:n] = col
+        for name, value in row.items():
+            columns[name][n] = value
+
+    def add(self, order):
+        prices = order.get("prices", {})
+        lines = []
+        for pid, qty in order.get("items", {}).items():
+            p = catalog.get(pid)
+            price = prices.get(pid, p.price if p else 0)
+            lines.append((int(pid), p.category if p else "Unknown", qty, qty * price))
+        with self.lock:
+            for pid, category, qty, revenue in lines:
+                self.append(self.lines, self.n_lines, {"key": self.line_key(pid, category), "qty": qty, "revenue": revenue})
+                self.n_lines += 1
+            self.append(self.orders, self.n_orders, {
+                "day": self.day(order["created_at"]), "total": order.get("total", 0),
+                "units": sum(line[2] for line in lines)
+            })
+            self.n_orders += 1
+
+    def report(self, top=10):
+        with self.lock:
+            o = {name: col[:self.n_orders] for name, col in self.orders.items()}
+            ln = {name: col[:self.n_lines] for name, col in self.lines.items()}
+            key_pid = np.array(self.key_pid)
+            key_category = np.array(self.key_category)
+            categories = list(self.categories)
+        n = len(o["total"])
+        if not n:
+            return {"orders": 0, "revenue": 0, "avg_basket_units": None, "avg_basket_value": None,
+                    "revenue_by_day": [], "revenue_by_category": [], "top_sellers": []}
+
+        first = int(o["day"].min())
+        day = o["day"] - first
+        day_revenue = np.bincount(day, weights=o["total"])
+        day_orders = np.bincount(day)
+
+        # per (product, category) key, then folded into products and categories
+        key_units = np.bincount(ln["key"], weights=ln["qty"], minlength=len(key_pid))
+        key_revenue = np.bincount(ln["key"], weights=ln["revenue"], minlength=len(key_pid))
+        cat_units = np.bincount(key_category, weights=key_units, minlength=len(categories))
+        cat_revenue = np.bincount(key_category, weights=key_revenue, minlength=len(categories))
+        pid_units = np.bincount(key_pid, weights=key_units)
+        pid_revenue = np.bincount(key_pid, weights=key_revenue, minlength=len(pid_units))
+        best = np.argpartition(-pid_units, top - 1)[:top] if len(pid_units) > top else np.arange(len(pid_units))
+        best = best[np.argsort(-pid_units[best], kind="stable")]
+
+        return {
+            "orders": n,
+            "revenue": int(o["total"].sum()),
+            "avg_basket_units": float(o["units"].mean()),
+            "avg_basket_value": float(o["total"].mean()),
+            "revenue_by_day": [
+                {"day": date.fromordinal(first + int(i)).isoformat(), "orders": int(day_orders[i]),
+                 "revenue": int(day_revenue[i])}
+                for i in np.flatnonzero(day_orders)
+            ],
+            "revenue_by_category": sorted(
+                ({"category": name, "units": int(cat_units[i]), "revenue": int(cat_revenue[i])}
+                 for i, name in enumerate(categories)),
+                key=lambda row: row["revenue"], reverse=True
+            ),
+            "top_sellers": [
+                {"id": int(pid), "name": p.name if p else None, "units": int(pid_units[pid]),
+                 "revenue": int(pid_revenue[pid])}
+                for pid, p in ((pid, catalog.get(int(pid))) for pid in best) if pid_units[pid] > 0
+            ],
+        }
+
+
+order_table = OrderTable(orders, storage.order_cursor) if np else None
+
+
+# -------------------- RECOMMENDATIONS --------------------
+# "Frequently bought together": a sparse co-occurrence matrix, one dict
+# per product of how many orders contained it together with each other
+# product. Checkout adds its basket; a row growing past PRUNE_AT is cut
+# back to its KEEP strongest neighbours, so memory stays linear in the
+# catalog. The startup rebuild counts every order exactly and prunes once
+# at the end. A product's top list is computed on the first lookup after
+# its row changes, so serving it is a dict get.
+class CoOccurrence:
+    TOP_K = 4
+    KEEP = 32
+    PRUNE_AT = 2 * KEEP
+    MAX_BASKET = 50     # caps the quadratic pair count of huge orders
+
+    def __init__(self, items=()):
+        self.rows = {}      # pid -> {other pid: orders together}
+        self.top = {}       # pid -> tuple of the TOP_K strongest neighbours
+        self.lock = threading.Lock()
+        for order in items:
+            self.count(self.basket(order), prune=False)
+        for pid in list(self.rows):
+            self.prune(pid)
+
+    @classmethod
+    def basket(cls, order):
+        pids = list(map(int, order.get("items", ())))
+        return pids if len(pids) <= cls.MAX_BASKET else sorted(pids)[:cls.MAX_BASKET]
+
+    def count(self, pids, prune=True):
+        for a in pids:
+            row = self.rows.get(a)
+            if row is None:
+                row = self.rows[a] = {}
+            for b in pids:
+                if b != a:
+                    row[b] = row.get(b, 0) + 1
+            self.top.pop(a, None)
+            if prune and len(row) > self.PRUNE_AT:
+                self.prune(a)
+
+    def prune(self, pid):
+        row = self.rows[pid]
+        if len(row) > self.KEEP:
+            self.rows[pid] = dict(heapq.nlargest(self.KEEP, row.items(), key=itemgetter(1)))
+
+    def add(self, order):
+        pids = self.basket(order)
+        if len(pids) > 1:
+            with self.lock:
+                self.count(pids)
+
+    def recommend(self, pid):
+        top = self.top.get(pid)
+        if top is None:
+            with self.lock:
+                row = self.rows.get(pid, {})
+                top = tuple(b for b, _ in heapq.nlargest(self.TOP_K, row.items(), key=lambda item: (item[1], -item[0])))
+                self.top[pid] = top
+        return top
+
+    def stats(self):
+        return {"products": len(self.rows), "pairs": sum(map(len, self.rows.values()))}
+
+
+with gc_paused():
+    bought_together = CoOccurrence(orders)
+del orders
 
 
 # -------------------- SYNC HELPERS --------------------
-def sync_products(): save_json(PRODUCTS_FILE, products)
-def sync_users(): save_json(USERS_FILE, users)
-def sync_orders(): save_json(ORDERS_FILE, orders)
+def sync_orders():
+    if ORDERS_FSYNC == "batch":
+        persister.mark(ORDERS_JOURNAL, order_journal.sync)
 
 
 # -------------------- FINDERS --------------------
 def find_product(pid):
-    pid = int(pid)
-    for p in products:
-        if int(p["id"]) == pid:
-            return p
-    return None
+    return catalog.get(pid)
 
 
 def find_user(username):
-    for u in users:
-        if u["username"] == username:
-            return u
-    return None
+    return storage.get_user(username)
+
+
+# -------------------- CROSS-WORKER REFRESH --------------------
+@app.before_request
+def refresh_catalog():
+    storage.refresh(catalog)
 
 
 # -------------------- GLOBALS TO JINJA --------------------
 @app.context_processor
 def inject_globals():
-    categories = sorted({p.get("category", "Other") for p in products})
     return {
-        "categories": categories,
+        "categories": facets.categories(),
         "dark_mode": session.get("dark_mode", False),
         "current_user": session.get("username"),
         "find_user": find_user,            # FIXED
-        "find_product": find_product       # FIXED
+        "find_product": find_product,      # FIXED
+        "stock_level": storage.stock_level
     }
 
 
+# -------------------- HTTP CACHING --------------------
+# Hash of the code and templates, so validators change on deploy.
+def build_id():
+    h = hashlib.blake2b(digest_size=8)
+    paths = [__file__] + sorted(
+        os.path.join(root, name)
+        for folder in (app.template_folder, app.static_folder)
+        for root, _, names in os.walk(os.path.join(BASE_DIR, folder))
+        for name in names
+    )
+    for path in paths:
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+BUILD_ID = build_id()
+STATIC_MAX_AGE = 365 * 24 * 3600
+static_hashes = {}
+
+
+def static_hash(filename):
+    if filename not in static_hashes:
+        try:
+            with open(os.path.join(app.static_folder, filename), "rb") as f:
+                static_hashes[filename] = hashlib.blake2b(f.read(), digest_size=6).hexdigest()
+        except OSError:
+            static_hashes[filename] = None
+    return static_hashes[filename]
+
+
+# url_for('static', ...) gets ?v=<content hash>, so the URL changes with the file
+@app.url_defaults
+def static_version(endpoint, values):
+    if endpoint == "static" and "filename" in values and "v" not in values:
+        digest = static_hash(values["filename"])
+        if digest:
+            values["v"] = digest
+
+
+@app.after_request
+def static_cache_headers(response):
+    if request.endpoint == "static" and response.status_code in (200, 304):
+        if request.args.get("v") == static_hash(request.view_args.get("filename", "")):
+            response.headers["Cache-Control"] = "public, max-age=%d, immutable" % STATIC_MAX_AGE
+    return response
+
+
+# Pages embed the navbar, so the validator also covers the logged-in user
+# and dark mode. Pages with pending flash messages are never revalidated.
+def conditional_page(parts, render):
+    if "_flashes" in session:
+        return render()
+    h = hashlib.blake2b(digest_size=12)
+    for part in (BUILD_ID, session.get("username"), session.get("dark_mode", False)) + parts:
+        h.update(repr(part).encode("utf-8"))
+        h.update(b"\0")
+    etag = h.hexdigest()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
 # -------------------- AUTH DECORATORS --------------------
 def login_required(f):
     @wraps(f)
@@ -106,36 +2495,215 @@ def admin_required(f):
     return wrap
 
 
-# -------------------- ROUTES --------------------
+# -------------------- REQUEST HELPERS --------------------
+def arg_int(name):
+    try:
+        return int(request.args[name])
+    except (KeyError, ValueError):
+        return None
 
-@app.route("/")
-def home():
-    q = request.args.get("q", "").strip().lower()
-    cat = request.args.get("category", "")
-    featured = request.args.get("featured") == "1"
 
-    filtered = []
+# the admin forms' stock field; blank means stock isn't tracked
+def form_stock():
+    value = request.form.get("stock", "").strip()
+    return max(int(value), 0) if value else None
 
-    for p in products:
-        ok = True
 
-        if q:
-            ok = q in p["name"].lower() or q in p["category"].lower()
+def listing_args():
+    return {
+        "q": request.args.get("q", "").strip(),
+        "category": request.args.get("category", ""),
+        "featured": request.args.get("featured") == "1",
+        "min_price": arg_int("min_price"),
+        "max_price": arg_int("max_price"),
+        "sort": request.args.get("sort", ""),
+        "after": parse_cursor(request.args.get("after")),
+        "limit": min(max(arg_int("limit") or PAGE_SIZE, 1), MAX_PAGE_SIZE),
+    }
+
 
-        if ok and cat:
-            ok = p["category"] == cat
+# Render a page as a stream of ~STREAM_CHUNK pieces. Pass generators as the
+# template data so neither the products nor the HTML are held in full.
+def stream_page(template, **context):
+    pieces = stream_template(template, **context)
+
+    def chunks():
+        buf, size = [], 0
+        for piece in pieces:
+            buf.append(piece)
+            size += len(piece)
+            if size >= STREAM_CHUNK:
+                yield "".join(buf)
+                buf, size = [], 0
+        if buf:
+            yield "".join(buf)
+    return app.response_class(chunks(), mimetype="text/html")
+
+
+# Idempotency key of a checkout POST (hidden form field or header), scoped
+# to the user so keys from different accounts can't collide.
+def checkout_key():
+    key = request.form.get("idempotency_key") or request.headers.get("Idempotency-Key")
+    if not key or len(key) > 128:
+        return None
+    return "%s:%s" % (session.get("username", ""), key)
+
+
+def page_url(endpoint, cursor):
+    if cursor is None:
+        return None
+    return url_for(endpoint, **{**request.args.to_dict(), "after": cursor})
+
+
+# A cart row for the template: the shared product record plus quantity.
+class CartLine:
+    __slots__ = ("product", "qty", "subtotal")
+
+    def __init__(self, product, qty):
+        self.product = product
+        self.qty = qty
+        self.subtotal = qty * product.price
+
+
+# Records of a JSON array or JSON Lines request body, decoded off the
+# stream a chunk at a time, so an upload of any size is never held in
+# memory whole. Values are read with raw_decode straight from the chunk,
+# without splitting it into lines or elements first. Iterating yields
+# (record, None), or (None, error) for a JSON Lines line that isn't one
+# JSON value; a malformed JSON array (including anything but whitespace
+# after its closing "]") raises ValueError, since nothing after the error
+# can be matched to an index. A body that isn't UTF-8 raises
+# UnicodeDecodeError, in either format.
+class BodyRecords:
+    CHUNK = 1024 * 1024
+    MAX_RECORD = 64 * 1024      # a value still undecodable this far in is malformed
+    decode = json.JSONDecoder().raw_decode
+    skip = re.compile(r"[ \t\n\r]*").match
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    # append the next chunk, dropping what was consumed; False once at the end
+    def fill(self):
+        if self.eof:
+            return False
+        data = self.stream.read(self.CHUNK)
+        self.eof = not data
+        self.buf = self.buf[self.pos:] + self.decoder.decode(data, final=self.eof)
+        self.pos = 0
+        return True
+
+    # the next non-blank character, or "" at the end
+    def peek(self):
+        while True:
+            self.pos = self.skip(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self.fill():
+                return self.buf[self.pos:self.pos + 1]
+
+    def __iter__(self):
+        return self.array() if self.peek() == "[" else self.lines()
+
+    def array(self):
+        self.pos += 1
+        if self.peek() == "]":
+            return self.close()
+        decode, skip = self.decode, self.skip
+        while True:
+            # values starting MAX_RECORD or more before the end of the
+            # chunk can't be cut off by it: take those in a tight loop
+            buf, pos = self.buf, self.pos
+            safe = len(buf) if self.eof else len(buf) - self.MAX_RECORD
+            between = False     # stopped after a value, before its delimiter
+            while pos < safe:
+                record, pos = decode(buf, pos)
+                yield record, None
+                pos = skip(buf, pos).end()
+                if pos == len(buf):
+                    between = True
+                    break
+                if buf[pos] == "]":
+                    self.pos = pos
+                    return self.close()
+                if buf[pos] != ",":
+                    raise ValueError("expected ',' or ']'")
+                pos = skip(buf, pos + 1).end()
+            self.pos = pos
+            if not between:
+                yield self.value(), None
+            c = self.peek()
+            if c == "]":
+                return self.close()
+            if c != ",":
+                raise ValueError("expected ',' or ']'")
+            self.pos += 1
+            self.peek()
+
+    # past the closing "]", where the body must end
+    def close(self):
+        self.pos += 1
+        if self.peek():
+            raise ValueError("data after ']'")
+
+    def value(self):
+        while True:
+            try:
+                record, end = self.decode(self.buf, self.pos)
+                # a number at the end of the chunk may continue in the next one
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return record
+            except ValueError:
+                if self.eof or len(self.buf) - self.pos > self.MAX_RECORD:
+                    raise
+            self.fill()
+
+    def lines(self):
+        decode, skip = self.decode, self.skip
+        while self.peek():
+            buf, pos = self.buf, self.pos
+            # complete lines only, unless this is the last chunk
+            last = len(buf) if self.eof else buf.rfind("\n")
+            if last < pos:
+                self.fill()
+                continue
+            while pos < last:
+                end = buf.find("\n", pos, last)
+                end = last if end < 0 else end
+                try:
+                    record, stop = decode(buf, pos)
+                    error = None if stop <= end and not buf[stop:end].strip() else "not one JSON value per line"
+                except ValueError:
+                    error = "malformed JSON"
+                yield (record, None) if error is None else (None, error)
+                pos = skip(buf, end).end()
+            self.pos = pos
 
-        if ok and featured:
-            ok = p.get("featured", False) is True
 
-        if ok:
-            ratings = p.get("ratings", [])
-            avg = sum(ratings) / len(ratings) if ratings else None
-            copy_p = p.copy()
-            copy_p["avg_rating"] = avg
-            filtered.append(copy_p)
+# -------------------- ROUTES --------------------
 
-    return render_template("home.html", products=filtered)
+@app.route("/")
+def home():
+    if request.args.get("all") == "1":
+        # the whole result set, streamed instead of paged or cached
+        args = listing_args()
+        del args["limit"]
+        return conditional_page(("listing", shared_version.read(), "all"), lambda: stream_page(
+            "home.html", products=filter(None, map(catalog.get, query_ids(**args))), next_url=None
+        ))
+
+    key = ("home", tuple(sorted(request.args.items(multi=True))))
+    return conditional_page(("listing", shared_version.read()), lambda: render_template(
+        "home.html", content=page_cache.fetch(key, ["listing"], render_home_content)
+    ))
+
+
+def render_home_content():
+    ids, cursor = query_page(**listing_args())
+    return render_template("home_content.html", products=[catalog.get(pid) for pid in ids], next_url=page_url("home", cursor))
 
 
 @app.route("/product/<int:pid>", methods=["GET", "POST"])
@@ -147,102 +2715,144 @@ def product_view(pid):
     if request.method == "POST":
         rating = int(request.form.get("rating", 0))
         if 1 <= rating <= 5:
-            product.setdefault("ratings", []).append(rating)
-            sync_products()
+            catalog.rate(product, rating)
+            storage.add_ratings({pid: rating_hist(rating)})
             flash("Thanks for rating!", "success")
         return redirect(url_for('product_view', pid=pid))
 
-    return render_template("product.html", product=product)
+    # outside the cached fragment: it changes with every order, not with the product
+    together = [p for p in map(find_product, bought_together.recommend(pid)) if p]
+    band = stock_band(storage.stock_level(product))
+    return conditional_page((
+        "product", json.dumps(product.to_dict(), sort_keys=True), band, [(p.id, p.name, p.price, p.img) for p in together]
+    ), lambda: render_template(
+        "product.html", together=together, content=page_cache.fetch(
+            ("product", pid, band), [("product", pid)],
+            lambda: render_template("product_content.html", product=product, band=band)
+        )
+    ))
 
 
 @app.route("/add/<int:pid>")
 def add_to_cart(pid):
-    cart = session.get("cart", {})
+    p = find_product(pid)
+    if p and storage.stock_level(p) == 0:
+        flash("Sorry, that's out of stock", "warning")
+        return redirect(request.referrer or url_for("home"))
+    cart = cart_store.load()
     cart[str(pid)] = cart.get(str(pid), 0) + 1
-    session["cart"] = cart
-    session.modified = True
+    cart_store.save(cart)
     flash("Added to cart", "success")
     return redirect(request.referrer or url_for("home"))
 
 
 @app.route("/cart")
 def cart():
-    cart = session.get("cart", {})
+    cart = cart_store.load()
     items = []
     total = 0
 
     for pid, qty in cart.items():
         product = find_product(pid)
         if product:
-            item = product.copy()
-            item["qty"] = qty
-            item["subtotal"] = qty * product["price"]
+            item = CartLine(product, qty)
             items.append(item)
-            total += item["subtotal"]
+            total += item.subtotal
 
     return render_template("cart.html", items=items, total=total)
 
 
 @app.route("/cart/increase/<int:pid>")
 def increase(pid):
-    cart = session.get("cart", {})
+    cart = cart_store.load()
     cart[str(pid)] = cart.get(str(pid), 0) + 1
-    session["cart"] = cart
-    session.modified = True
+    cart_store.save(cart)
     return redirect(url_for("cart"))
 
 
 @app.route("/cart/decrease/<int:pid>")
 def decrease(pid):
-    cart = session.get("cart", {})
+    cart = cart_store.load()
     if str(pid) in cart:
         cart[str(pid)] -= 1
         if cart[str(pid)] <= 0:
             cart.pop(str(pid))
-    session["cart"] = cart
-    session.modified = True
+    cart_store.save(cart)
     return redirect(url_for("cart"))
 
 
 @app.route("/remove/<int:pid>")
 def remove(pid):
-    cart = session.get("cart", {})
+    cart = cart_store.load()
     cart.pop(str(pid), None)
-    session["cart"] = cart
-    session.modified = True
+    cart_store.save(cart)
     return redirect(url_for("cart"))
 
 
 @app.route("/checkout", methods=["GET", "POST"])
 def checkout():
     if request.method == "POST":
-        cart = session.get("cart", {})
+        key = checkout_key()
+        if key and storage.checkout_order(key) is not None:
+            # a retry or double submit of an order that already went through
+            flash("Order placed successfully!", "success")
+            return redirect(url_for("home"))
+
+        cart = cart_store.load()
         if not cart:
             flash("Your cart is empty.", "warning")
             return redirect(url_for("cart"))
 
         total = 0
+        prices = {}
         for pid, qty in cart.items():
             p = find_product(pid)
             if p:
-                total += p["price"] * qty
+                prices[pid] = p.price
+                total += p.price * qty
 
         order = {
-            "id": len(orders) + 1,
+            "id": None,     # assigned by the storage backend
             "user": session.get("username"),
             "items": cart,
+            "prices": prices,
             "total": total,
             "created_at": datetime.utcnow().isoformat()
         }
 
-        orders.append(order)
-        sync_orders()
-
-        session.pop("cart", None)
+        order_id, placed, stock = storage.place_order(order, key)
+        levels = [(p, left) for p, left in ((find_product(pid), left) for pid, left in stock.items()) if p]
+        for p, left in levels:
+            catalog.update(p, stock=left)
+        if order_id is None:
+            flash("Not enough stock: " + ", ".join("%s (%d left)" % (p.name, left) for p, left in levels), "warning")
+            return redirect(url_for("cart"))
+        if placed:
+            bought_together.add(order)
+            for pid, qty in cart.items():
+                p = find_product(pid)
+                if p:
+                    catalog.change(p, ["sales"], lambda p, qty=qty: suggester.record_sale(p, qty))
+
+        cart_store.clear()
         flash("Order placed successfully!", "success")
         return redirect(url_for("home"))
 
-    return render_template("checkout.html")
+    return render_template("checkout.html", idempotency_key=secrets.token_urlsafe(16))
+
+
+@app.route("/orders")
+@login_required
+def order_history():
+    return render_order_history(session["username"])
+
+
+def render_order_history(user, **template_args):
+    limit = min(max(arg_int("limit") or PAGE_SIZE, 1), MAX_PAGE_SIZE)
+    page = storage.order_history(user, arg_int("after"), limit + 1)
+    cursor = page[limit - 1]["id"] if len(page) > limit else None
+    return render_template("orders.html", orders=page[:limit], next_url=page_url(request.endpoint, cursor),
+                           **template_args)
 
 
 # -------------------- WISHLIST --------------------
@@ -257,7 +2867,7 @@ def wishlist_view():
     else:
         plist = session.get("wishlist", [])
 
-    wishlist_items = [find_product(pid) for pid in plist if find_product(pid)]
+    wishlist_items = [p for p in map(find_product, plist) if p]
 
     return render_template("wishlist.html", items=wishlist_items)
 
@@ -267,8 +2877,7 @@ def wishlist_add(pid):
     if session.get("username"):
         user = find_user(session["username"])
         if pid not in user["wishlist"]:
-            user["wishlist"].append(pid)
-            sync_users()
+            storage.update_user(user["username"], lambda u: u["wishlist"].update({pid: None}))
     else:
         w = session.get("wishlist", [])
         if pid not in w:
@@ -282,8 +2891,8 @@ def wishlist_add(pid):
 def wishlist_remove(pid):
     if session.get("username"):
         user = find_user(session["username"])
-        user["wishlist"] = [x for x in user["wishlist"] if x != pid]
-        sync_users()
+        if pid in user["wishlist"]:
+            storage.update_user(user["username"], lambda u: u["wishlist"].pop(pid, None))
     else:
         w = session.get("wishlist", [])
         session["wishlist"] = [x for x in w if x != pid]
@@ -303,13 +2912,10 @@ def signup():
             flash("Enter username & password.", "warning")
             return redirect(url_for("signup"))
 
-        if find_user(u):
+        if not storage.add_user({"username": u, "password": p, "is_admin": False, "wishlist": {}}):
             flash("Username already exists.", "warning")
             return redirect(url_for("signup"))
 
-        users.append({"username": u, "password": p, "is_admin": False, "wishlist": []})
-        sync_users()
-
         session["username"] = u
         flash("Signup successful!", "success")
         return redirect(url_for("home"))
@@ -346,7 +2952,18 @@ def logout():
 @app.route("/admin")
 @admin_required
 def admin_dashboard():
-    return render_template("admin_dashboard.html", products=products)
+    if request.args.get("all") == "1":
+        return stream_page("admin_dashboard.html", products=filter(None, map(catalog.get, query_ids())), next_url=None)
+
+    ids, cursor = query_page(
+        after=parse_cursor(request.args.get("after")),
+        limit=min(max(arg_int("limit") or PAGE_SIZE, 1), MAX_PAGE_SIZE)
+    )
+    return render_template(
+        "admin_dashboard.html",
+        products=map(catalog.get, ids),
+        next_url=page_url("admin_dashboard", cursor)
+    )
 
 
 @app.route("/admin/add", methods=["GET", "POST"])
@@ -359,18 +2976,10 @@ def admin_add():
         cat = request.form["category"]
         featured = request.form.get("featured") == "on"
 
-        new_id = max([p["id"] for p in products] or [0]) + 1
-
-        products.append({
-            "id": new_id,
-            "name": name,
-            "price": price,
-            "img": img,
-            "category": cat,
-            "ratings": [],
-            "featured": featured
-        })
-        sync_products()
+        # storage assigns the id
+        p = Product(0, name, price, img, cat, featured, stock=form_stock())
+        storage.add_product(p)
+        catalog.put(p)
 
         flash("Product added!", "success")
         return redirect(url_for("admin_dashboard"))
@@ -387,12 +2996,19 @@ def admin_edit(pid):
         return redirect(url_for("admin_dashboard"))
 
     if request.method == "POST":
-        p["name"] = request.form["name"]
-        p["price"] = int(request.form["price"])
-        p["img"] = request.form["img"]
-        p["category"] = request.form["category"]
-        p["featured"] = request.form.get("featured") == "on"
-        sync_products()
+        catalog.update(
+            p,
+            name=request.form["name"],
+            price=int(request.form["price"]),
+            img=request.form["img"],
+            category=request.form["category"],
+            featured=request.form.get("featured") == "on"
+        )
+        storage.save_product(p)
+        # only when changed in the form, so units sold while it was open stay sold
+        if request.form.get("stock", "").strip() != request.form.get("stock_was"):
+            catalog.update(p, stock=form_stock())
+            storage.set_stock(p)
 
         flash("Updated!", "success")
         return redirect(url_for("admin_dashboard"))
@@ -403,13 +3019,39 @@ def admin_edit(pid):
 @app.route("/admin/delete/<int:pid>")
 @admin_required
 def admin_delete(pid):
-    global products
-    products = [p for p in products if p["id"] != pid]
-    sync_products()
+    catalog.remove(pid)
+    storage.delete_product(pid)
     flash("Deleted!", "info")
     return redirect(url_for("admin_dashboard"))
 
 
+@app.route("/admin/orders")
+@admin_required
+def admin_orders():
+    return render_order_history(request.args.get("user") or None, show_user=True)
+
+
+@app.route("/admin/analytics")
+@admin_required
+def admin_analytics():
+    if np is None:
+        return jsonify({"error": "order analytics need numpy"}), 501
+    top = min(max(arg_int("top") or 10, 1), 100)
+    order_table.catch_up(storage)
+    return jsonify(order_table.report(top))
+
+
+@app.route("/admin/stats")
+@admin_required
+def admin_stats():
+    return jsonify({
+        "persistence": persister.snapshot(),
+        "carts": cart_store.stats(),
+        "page_cache": page_cache.snapshot(),
+        "bought_together": bought_together.stats()
+    })
+
+
 # -------------------- DARK MODE --------------------
 
 @app.route("/toggle-dark")
@@ -430,8 +3072,8 @@ def api_rate(pid):
     try:
         rating = int(request.json.get("rating"))
         if 1 <= rating <= 5:
-            p.setdefault("ratings", []).append(rating)
-            sync_products()
+            catalog.rate(p, rating)
+            storage.add_ratings({pid: rating_hist(rating)})
             return jsonify({"ok": True})
     except:
         pass
@@ -439,6 +3081,120 @@ def api_rate(pid):
     return jsonify({"error": "invalid"}), 400
 
 
+# Ratings in bulk, for admins: a JSON array or JSON Lines body of
+# {"pid": ..., "rating": ...} records. Valid records are tallied into a
+# per-product histogram while the body streams in, then applied to each
+# product once and saved in one write. Invalid records are skipped and
+# reported by their position.
+RATE_BATCH_ERRORS_SHOWN = 1000
+
+
+@app.route("/api/rate/batch", methods=["POST"])
+@admin_required
+def api_rate_batch():
+    hists = {}      # pid -> ratings per star
+    errors, rejected, index = [], 0, -1
+    try:
+        for index, (record, error) in enumerate(BodyRecords(request.stream)):
+            if error is None:
+                try:
+                    pid, rating = record["pid"], record["rating"]
+                except (KeyError, TypeError):
+                    error = "needs a pid and a rating"
+                else:
+                    # JSON integers only: 4.9, true and "5" are rejected, not coerced
+                    if type(pid) is not int or type(rating) is not int:
+                        error = "pid and rating must be integers"
+                    elif not 1 <= rating <= 5:
+                        error = "rating must be 1-5"
+                    elif catalog.get(pid) is None:
+                        error = "unknown product"
+            if error:
+                rejected += 1
+                if len(errors) < RATE_BATCH_ERRORS_SHOWN:
+                    errors.append({"index": index, "error": error})
+                continue
+            hist = hists.get(pid)
+            if hist is None:
+                hist = hists[pid] = [0, 0, 0, 0, 0]
+            hist[rating - 1] += 1
+    except UnicodeDecodeError:
+        # checked first: it is a ValueError too
+        return jsonify({"error": "body is not valid UTF-8", "records_read": index + 1}), 400
+    except ValueError:
+        # nothing is applied from a body that isn't valid JSON
+        return jsonify({"error": "malformed JSON array", "records_read": index + 1}), 400
+
+    rated = {pid: hist for pid, hist in hists.items() if catalog.get(pid)}
+    for pid, hist in rated.items():
+        catalog.rate_many(catalog.get(pid), hist)
+    if rated:
+        storage.add_ratings(rated)
+    return jsonify({
+        "accepted": sum(map(sum, hists.values())),
+        "rejected": rejected,
+        "products": len(rated),
+        "errors": errors
+    })
+
+
+@app.route("/api/products")
+def api_products():
+    ids, cursor = query_page(**listing_args())
+    items = [dict(p.to_dict(), avg_rating=p.avg_rating, stock=storage.stock_level(p)) for p in map(catalog.get, ids)]
+    return jsonify({"products": items, "next": cursor})
+
+
+@app.route("/api/suggest")
+def api_suggest():
+    catalog.use(suggester)
+    with catalog.lock:
+        suggestions = suggester.suggest(request.args.get("q", ""))
+    return jsonify({"suggestions": suggestions})
+
+
+# -------------------- CLI --------------------
+
+@app.cli.command("import-json")
+def import_json():
+    """Copy products.json, users.json and the order journal into SQLite."""
+    if not isinstance(storage, SqliteStorage):
+        print("Set STORAGE=sqlite to import into %s" % SQLITE_PATH)
+        return
+    print("imported %d products, %d users, %d orders" % storage.import_from(JsonStorage()))
+
+
+@app.cli.command("compact-orders")
+def compact_orders():
+    """Rewrite orders.jsonl without torn or superseded lines and expire old checkout keys."""
+    print(f"{order_journal.compact()} orders kept")
+    print(f"{storage.expire_checkout_keys(CHECKOUT_KEY_TTL)} checkout keys expired")
+
+
+# -------------------- SHARED CATALOG --------------------
+# Forked workers share the master's pages until something writes to them,
+# and a cyclic collection writes to the header of every object it scans.
+# So the master finishes all lazy work (indexes, sorts, the category list)
+# and moves the heap into the GC's permanent generation; workers then only
+# copy the pages of objects whose refcounts they actually touch. Catalog
+# changes keep arriving through refresh_catalog, which swaps fresh records
+# in for the changed products only.
+def share_catalog():
+    for index in list(catalog.lazy):
+        catalog.use(index)
+    for index, _ in SORTS.values():
+        index.ensure_sorted()
+    facets.categories()
+    # nothing may be mid-write in the persister when gunicorn forks
+    persister.flush_all()
+    gc.collect()
+    gc.freeze()
+
+
+if SHARED_CATALOG:
+    share_catalog()
+
+
 # -------------------- RUN --------------------
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+"""Cart page latency against catalog size.
+
+Builds a catalog of each size in a scratch copy of the app, fills a cart
+with 20 products from the end of the catalog (the worst case for a linear
+scan) and times GET /cart, next to a linear scan for the same products.
+
+    python bench/bench_cart.py [SIZE ...]       # default 10000 100000 1000000
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CART = 20
+ROUNDS = 50
+
+
+def make_app(d, n):
+    shutil.copy(os.path.join(ROOT, "app.py"), d)
+    for name in ("templates", "static"):
+        shutil.copytree(os.path.join(ROOT, name), os.path.join(d, name))
+    with open(os.path.join(d, "products.json"), "w", encoding="utf-8") as f:
+        json.dump([{"id": i, "name": "Item %d" % i, "price": i % 997 + 1, "img": "", "category": "C%d" % (i % 40),
+                    "featured": i % 50 == 0} for i in range(1, n + 1)], f)
+    for name in ("users.json", "orders.json"):
+        with open(os.path.join(d, name), "w", encoding="utf-8") as f:
+            f.write("[]")
+
+
+# runs in the scratch directory, in a process of its own per size
+def measure(n):
+    sys.path.insert(0, os.getcwd())
+    import app
+    client = app.app.test_client()
+    pids = list(range(n, n - CART, -1))
+    for pid in pids:
+        client.get("/add/%d" % pid)
+    client.get("/cart")
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        client.get("/cart")
+    cart = (time.perf_counter() - start) / ROUNDS
+
+    products = list(app.catalog)
+    start = time.perf_counter()
+    for pid in pids:
+        next(p for p in products if p.id == pid)
+    scan = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for pid in pids:
+            app.find_product(pid)
+    lookup = (time.perf_counter() - start) / ROUNDS
+    print("%9d products: GET /cart %7.2f ms   %d lookups %7.3f ms   linear scan %9.2f ms"
+          % (n, cart * 1000, CART, lookup * 1000, scan * 1000))
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--measure":
+        return measure(int(sys.argv[2]))
+    for n in [int(a) for a in sys.argv[1:]] or [10000, 100000, 1000000]:
+        with tempfile.TemporaryDirectory() as d:
+            make_app(d, n)
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", str(n)], cwd=d, check=True,
+                           env=dict(os.environ, STORAGE="json"))
+
+
+if __name__ == "__main__":
+    main()
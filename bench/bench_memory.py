@@ -0,0 +1,59 @@
+"""Catalog memory: plain dict records against Product records.
+
+Builds N products both ways and reports the traced memory per product
+and the build time.
+
+    python bench/bench_memory.py [N]            # default 1000000
+"""
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CATEGORIES = ["Computers", "Accessories", "Audio", "Lighting", "Gaming", "Home", "Kitchen", "Books"]
+
+
+def record(i):
+    return {"id": i, "name": "Product %d" % i, "price": 100 + i % 5000, "img": "https://img.example/%d.jpg" % i,
+            # a fresh string per record, as json.load gives
+            "category": "".join(CATEGORIES[i % 8]), "featured": i % 10 == 0,
+            "rating": {"count": i % 7, "sum": (i % 7) * 4, "hist": [0, 0, 0, i % 7, 0]}, "stock": None}
+
+
+def measure(n, make):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    items = [make(record(i)) for i in range(n)]
+    seconds = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    return size, seconds
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    # importing the app sets up its data files beside it, so use a scratch copy
+    d = tempfile.mkdtemp()
+    for name in ("app.py", "products.json", "users.json", "orders.json"):
+        shutil.copy(os.path.join(ROOT, name), d)
+    for name in ("templates", "static"):
+        shutil.copytree(os.path.join(ROOT, name), os.path.join(d, name))
+    os.chdir(d)
+    sys.path.insert(0, d)
+    try:
+        from app import Product
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+    for label, make in (("dict records", lambda d: d), ("Product records", Product.from_dict)):
+        size, seconds = measure(n, make)
+        print("%-16s %5.0f MB, %4d B/product, built in %.2fs" % (label + ":", size / 2 ** 20, size / n, seconds))
+
+
+if __name__ == "__main__":
+    main()
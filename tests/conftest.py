@@ -0,0 +1,66 @@
+import os
+import shutil
+import subprocess
+import sys
+from multiprocessing import get_context
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# A copy of the app with its own data files, so tests never touch the real ones.
+@pytest.fixture
+def app_dir(tmp_path):
+    for name in ("app.py", "products.json", "users.json", "orders.json"):
+        shutil.copy(os.path.join(ROOT, name), tmp_path)
+    for name in ("templates", "static"):
+        shutil.copytree(os.path.join(ROOT, name), tmp_path / name)
+    return tmp_path
+
+
+def backend_env(app_dir, backend):
+    env = {"STORAGE": backend, "SQLITE_PATH": str(app_dir / "store.db"), "PERSIST_INTERVAL": "0.05"}
+    if backend == "sqlite":
+        subprocess.run([sys.executable, "-m", "flask", "--app", "app", "import-json"], cwd=app_dir,
+                       env=dict(os.environ, **env), check=True, capture_output=True)
+    return env
+
+
+def load_app(app_dir, env):
+    os.environ.update(env)
+    os.chdir(app_dir)
+    sys.path.insert(0, str(app_dir))
+    import app
+    return app
+
+
+def _worker(app_dir, env, target, args, results):
+    try:
+        results.put(target(load_app(app_dir, env), *args))
+    except BaseException as e:
+        results.put(e)
+        raise
+
+
+# Run target(app, *args) in each of n forked processes that import the app
+# on their own, like gunicorn workers without --preload; returns what the
+# calls returned. The test process itself never imports the app.
+def run_workers(app_dir, env, target, n, *args):
+    ctx = get_context("fork")
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_worker, args=(app_dir, env, target, args + (i,), results)) for i in range(n)]
+    for p in procs:
+        p.start()
+    out = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+    for result in out:
+        if isinstance(result, BaseException):
+            raise result
+    return out
+
+
+def checkout_key(client):
+    html = client.get("/checkout").get_data(as_text=True)
+    return html.split('name="idempotency_key" value="', 1)[1].split('"', 1)[0]
@@ -0,0 +1,37 @@
+import os
+from multiprocessing import get_context
+
+import pytest
+
+from conftest import backend_env, run_workers
+
+WORKERS = int(os.environ.get("ADD_WORKERS", 4))
+ADDS = int(os.environ.get("ADD_ADDS", 10))     # per worker
+
+
+def add_products(app, start, worker):
+    client = app.app.test_client()
+    with client.session_transaction() as s:
+        s["username"] = "dhruba"
+    start.wait()
+    for i in range(ADDS):
+        r = client.post("/admin/add", data={"name": "w%d-%d" % (worker, i), "price": "10", "img": "",
+                                             "category": "Added", "stock": ""})
+        assert r.status_code == 302
+    app.persister.flush_all()
+
+
+# what a worker started afterwards loads
+def added(app_dir, env):
+    def names(app, worker):
+        return sorted((p.id, p.name) for p in app.catalog if p.category == "Added")
+    return run_workers(app_dir, env, names, 1)[0]
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_products_added_at_once_get_their_own_ids(app_dir, backend):
+    env = backend_env(app_dir, backend)
+    run_workers(app_dir, env, add_products, WORKERS, get_context("fork").Barrier(WORKERS))
+    products = added(app_dir, env)
+    assert sorted(name for _, name in products) == sorted("w%d-%d" % (w, i) for w in range(WORKERS) for i in range(ADDS))
+    assert len({pid for pid, _ in products}) == len(products)
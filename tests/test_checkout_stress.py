@@ -0,0 +1,77 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from conftest import backend_env, checkout_key, run_workers
+
+WORKERS = int(os.environ.get("STRESS_WORKERS", 4))
+THREADS = int(os.environ.get("STRESS_THREADS", 4))
+CHECKOUTS = int(os.environ.get("STRESS_CHECKOUTS", 25))     # per thread
+
+
+# Every checkout is submitted twice at once and retried once more, as a
+# double click followed by a reload would.
+def place_orders(app, worker):
+    def submit(client, data):
+        client.post("/checkout", data=data)
+
+    def run():
+        client = app.app.test_client()
+        for _ in range(CHECKOUTS):
+            client.get("/add/1")
+            client.get("/add/3")
+            data = {"idempotency_key": checkout_key(client)}
+            clicks = []
+            for _ in range(2):
+                click = app.app.test_client()
+                click.set_cookie("session", client.get_cookie("session").value)
+                clicks.append(threading.Thread(target=submit, args=(click, data)))
+            for t in clicks:
+                t.start()
+            for t in clicks:
+                t.join()
+            submit(client, data)
+            with client.session_transaction() as s:
+                s.pop("cart", None)
+            placed.append(data["idempotency_key"])
+
+    placed = []
+    threads = [threading.Thread(target=run) for _ in range(THREADS)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    app.persister.flush_all()
+    return time.perf_counter() - start, len(placed)
+
+
+def stored_orders(app_dir, backend):
+    if backend == "sqlite":
+        with sqlite3.connect(app_dir / "store.db") as conn:
+            return [json.loads(data) for data, in conn.execute("SELECT data FROM orders ORDER BY id")]
+    with open(app_dir / "orders.jsonl", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_concurrent_checkouts_get_unique_ids(app_dir, backend):
+    env = backend_env(app_dir, backend)
+    with open(app_dir / "orders.json", encoding="utf-8") as f:
+        before = len(json.load(f))      # imported ahead of the new ones
+    results = run_workers(app_dir, env, place_orders, WORKERS)
+
+    orders = stored_orders(app_dir, backend)[before:]
+    ids = [o["id"] for o in orders]
+    placed = sum(n for _, n in results)
+    assert placed == WORKERS * THREADS * CHECKOUTS
+    assert len(ids) == len(set(ids)), "duplicate order ids"
+    assert len(orders) == placed, "a double submit placed two orders"
+
+    seconds = max(t for t, _ in results)
+    print("\n%s: %d checkouts (3 POSTs each) from %d workers x %d threads in %.2fs, %.0f orders/s"
+          % (backend, placed, WORKERS, THREADS, seconds, placed / seconds))
@@ -0,0 +1,42 @@
+import json
+import os
+from multiprocessing import get_context
+
+from conftest import backend_env, checkout_key, run_workers
+
+WORKERS = int(os.environ.get("COMPACT_WORKERS", 4))      # one of them compacts
+CHECKOUTS = int(os.environ.get("COMPACT_CHECKOUTS", 40))    # per checkout worker
+
+
+# `flask compact-orders` run over and over while the other workers take orders
+def checkout_or_compact(app, done, worker):
+    if worker == 0:
+        runs = 0
+        while done.value < WORKERS - 1 or not runs:
+            app.order_journal.compact()
+            runs += 1
+        return "compactions", runs
+    client = app.app.test_client()
+    placed = 0
+    for _ in range(CHECKOUTS):
+        client.get("/add/1")
+        if client.post("/checkout", data={"idempotency_key": checkout_key(client)}).status_code == 302:
+            placed += 1
+    app.persister.flush_all()
+    with done.get_lock():
+        done.value += 1
+    return "placed", placed
+
+
+def test_compacting_while_orders_arrive_keeps_them(app_dir):
+    env = backend_env(app_dir, "json")
+    with open(app_dir / "orders.json", encoding="utf-8") as f:
+        before = len(json.load(f))
+    results = dict(run_workers(app_dir, env, checkout_or_compact, WORKERS, get_context("fork").Value("i", 0)))
+
+    with open(app_dir / "orders.jsonl", encoding="utf-8") as f:
+        orders = [json.loads(line) for line in f if line.strip()]
+    assert results["placed"] == CHECKOUTS
+    assert len(orders) - before == (WORKERS - 1) * CHECKOUTS
+    assert len({o["id"] for o in orders}) == len(orders)
+    print("\n%d orders kept across %d compactions" % (len(orders) - before, results["compactions"]))
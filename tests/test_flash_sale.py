@@ -0,0 +1,83 @@
+import json
+import os
+import random
+import sqlite3
+import struct
+import threading
+import time
+
+import pytest
+
+from conftest import backend_env, checkout_key, run_workers
+
+WORKERS = int(os.environ.get("FLASH_WORKERS", 4))
+THREADS = int(os.environ.get("FLASH_THREADS", 4))
+ATTEMPTS = int(os.environ.get("FLASH_ATTEMPTS", 20))     # checkouts per thread
+STOCK = {1: 15, 2: 40, 3: 150}      # demand is about 2 units per attempt, spread over these
+
+
+def seed_stock(app_dir):
+    with open(app_dir / "products.json", encoding="utf-8") as f:
+        products = json.load(f)
+    for p in products:
+        p["stock"] = STOCK.get(p["id"])
+    with open(app_dir / "products.json", "w", encoding="utf-8") as f:
+        json.dump(products, f)
+
+
+# Every thread fills random baskets of the sale products, in random order
+# so reservations lock them in different orders, and checks out.
+def buy(app, worker):
+    def run(seed):
+        rng = random.Random(seed)
+        client = app.app.test_client()
+        for _ in range(ATTEMPTS):
+            for pid in rng.sample(sorted(STOCK), rng.randint(1, len(STOCK))):
+                client.get("/add/%d" % pid)
+            client.post("/checkout", data={"idempotency_key": checkout_key(client)})
+            with client.session_transaction() as s:
+                s.pop("cart", None)
+
+    threads = [threading.Thread(target=run, args=(worker * THREADS + i,)) for i in range(THREADS)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    app.persister.flush_all()
+    return time.perf_counter() - start
+
+
+def outcome(app_dir, backend):
+    if backend == "sqlite":
+        with sqlite3.connect(app_dir / "store.db") as conn:
+            orders = [json.loads(data) for data, in conn.execute("SELECT data FROM orders")]
+            left = dict(conn.execute("SELECT id, stock FROM products WHERE stock IS NOT NULL"))
+    else:
+        with open(app_dir / "orders.jsonl", encoding="utf-8") as f:
+            orders = [json.loads(line) for line in f if line.strip()]
+        with open(app_dir / "stock.levels", "rb") as f:
+            levels = f.read()
+        left = {pid: struct.unpack_from("<q", levels, 8 * pid)[0] - 1 for pid in STOCK}
+    sold = dict.fromkeys(STOCK, 0)
+    for order in orders:
+        for pid, qty in order["items"].items():
+            sold[int(pid)] += qty
+    return orders, sold, left
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_flash_sale_never_oversells(app_dir, backend):
+    seed_stock(app_dir)
+    env = backend_env(app_dir, backend)
+    seconds = max(run_workers(app_dir, env, buy, WORKERS))
+
+    orders, sold, left = outcome(app_dir, backend)
+    for pid, stock in STOCK.items():
+        assert left[pid] >= 0
+        assert sold[pid] + left[pid] == stock, "product %d: %d sold, %d left of %d" % (pid, sold[pid], left[pid], stock)
+    assert left[1] == 0, "the sale should have sold out"
+
+    attempts = WORKERS * THREADS * ATTEMPTS
+    print("\n%s: %d checkouts from %d workers x %d threads in %.2fs, %.0f/s; %d placed, sold %s of %s"
+          % (backend, attempts, WORKERS, THREADS, seconds, attempts / seconds, len(orders), sold, STOCK))
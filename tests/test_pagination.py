@@ -0,0 +1,17 @@
+from conftest import backend_env, run_workers
+
+BAD_CURSORS = ["-5:1", "nan:1", "inf:1", "-inf:1", "1e300:1", "5", "x:y", "1:2:3"]
+
+
+def fetch(app, worker):
+    client = app.app.test_client()
+    statuses = {}
+    for url in ("/?q=laptop", "/?sort=price", "/api/products?q=x", "/api/products?sort=rating"):
+        for after in BAD_CURSORS:
+            statuses[url + "&after=" + after] = client.get(url + "&after=" + after).status_code
+    return statuses
+
+
+def test_bad_cursors_are_ignored(app_dir):
+    statuses = run_workers(app_dir, backend_env(app_dir, "json"), fetch, 1)[0]
+    assert {url: code for url, code in statuses.items() if code != 200} == {}
@@ -0,0 +1,36 @@
+import json
+
+import pytest
+
+from conftest import backend_env, run_workers
+
+BODIES = {
+    "array": (b'[{"pid": 1, "rating": 4}, {"pid": 1, "rating": 5}]', 200, None),
+    "array with trailing blanks": (b'[{"pid": 1, "rating": 4}]  \n', 200, None),
+    "empty array": (b"[] ", 200, None),
+    "data after the array": (b'[{"pid": 1, "rating": 1}] garbage', 400, "malformed JSON array"),
+    "second array": (b'[{"pid": 1, "rating": 1}][]', 400, "malformed JSON array"),
+    "data after a long array": (json.dumps([{"pid": 1, "rating": 3}] * 5000).encode() + b" x", 400,
+                                "malformed JSON array"),
+    "data after an empty array": (b"[] x", 400, "malformed JSON array"),
+    "invalid UTF-8 in an array": (b'[{"pid": 1, "rating": 4}, "\xff"]', 400, "body is not valid UTF-8"),
+    "invalid UTF-8 in JSON Lines": (b'{"pid": 1, "rating": 4}\n{"pid": \xff}\n', 400, "body is not valid UTF-8"),
+}
+
+
+def post(app, body, worker):
+    client = app.app.test_client()
+    with client.session_transaction() as s:
+        s["username"] = "dhruba"
+    before = app.catalog.get(1).rating_count
+    r = client.post("/api/rate/batch", data=body)
+    return r.status_code, r.get_json().get("error"), app.catalog.get(1).rating_count - before
+
+
+@pytest.mark.parametrize("name", BODIES)
+def test_batch_body_must_be_valid_to_the_end(app_dir, name):
+    body, status, error = BODIES[name]
+    code, got, rated = run_workers(app_dir, backend_env(app_dir, "json"), post, 1, body)[0]
+    assert (code, got) == (status, error)
+    if status != 200:
+        assert rated == 0, "records from a rejected body were applied"
@@ -0,0 +1,43 @@
+import os
+import time
+from multiprocessing import get_context
+
+import pytest
+
+from conftest import backend_env, run_workers
+
+WORKERS = int(os.environ.get("RATING_WORKERS", 4))
+RATINGS = int(os.environ.get("RATING_RATINGS", 50))     # per worker
+
+
+# Rate, wait for the others, then report what this worker's catalog shows.
+def rate(app, done, worker):
+    client = app.app.test_client()
+    for _ in range(RATINGS):
+        assert client.post("/api/rate/1", json={"rating": 4}).status_code == 200
+    app.persister.flush_all()
+    with done.get_lock():
+        done.value += 1
+    while done.value < WORKERS:
+        time.sleep(0.01)
+    app.refresh_catalog()
+    return app.catalog.get(1).rating_count
+
+
+# what a worker started afterwards loads
+def stored_count(app_dir, env, pid):
+    def count(app, worker):
+        return app.catalog.get(pid).rating_count
+    return run_workers(app_dir, env, count, 1)[0]
+
+
+# "json-folding" folds the product log into products.json every few ratings
+@pytest.mark.parametrize("backend", ["json", "json-folding", "sqlite"])
+def test_ratings_from_every_worker_are_kept(app_dir, backend):
+    env = backend_env(app_dir, backend.split("-")[0])
+    if backend == "json-folding":
+        env["PRODUCTS_LOG_MAX"] = "512"
+    before = stored_count(app_dir, env, 1)
+    seen = run_workers(app_dir, env, rate, WORKERS, get_context("fork").Value("i", 0))
+    assert stored_count(app_dir, env, 1) - before == WORKERS * RATINGS
+    assert seen == [before + WORKERS * RATINGS] * WORKERS, "a worker's catalog missed ratings"